@@ -0,0 +1,101 @@
+# Compares plain JSON message rows against zlib and zstd compressed rows (see
+# utils/compression.py): on-disk size of conversations.db, time to write every
+# message, and time to read every conversation back.
+#
+# Run from the repository root: python benchmarks/bench_conversation_compression.py
+# zstd is skipped when the zstandard package isn't installed.
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The benchmark databases are written to the working directory
+os.chdir(tempfile.mkdtemp())
+
+from utils import compression
+from utils.schemas import CONVERSATIONS_SCHEMA, apply_migrations
+
+# The statements utils/storage.py uses to write and read a conversation
+INSERT_MESSAGE = "INSERT INTO messages VALUES (?, ?, ?, ?)"
+SELECT_MESSAGES = "SELECT message FROM messages WHERE conversation_id = ? ORDER BY ordinal"
+
+NUM_CONVERSATIONS = 200
+MESSAGES_PER_CONVERSATION = 150
+
+WORDS = (
+    "the quick brown fox jumps over a lazy dog while byte explains recursion again python discord "
+    "server channel message timezone weather search result page answer question because however"
+).split()
+USERS = [(279718966543384578 + i, name) for i, name in enumerate(["xeniox", "alice", "bob", "carol", "dave"])]
+SYSTEM_PROMPT = (
+    "You are developed by a person called Xeniox. You are using the latest GPT-4 model. "
+    "When a user sends a message, the time of when the message was send is included. Use this to give a sense of time passing. "
+    "Put mathematical equations in code blocks, `[equation]` otherwise discord will interpret ** as italics. "
+)
+
+def make_conversations():
+    random.seed(42)
+    conversations = {}
+    for conversation_id in range(1, NUM_CONVERSATIONS + 1):
+        conversation = [{"role": "system", "content": SYSTEM_PROMPT}]
+        for i in range(MESSAGES_PER_CONVERSATION):
+            text = " ".join(random.choice(WORDS) for _ in range(random.randint(5, 120)))
+            if i % 2 == 0:
+                discord_id, username = random.choice(USERS)
+                day = random.choice(["Mon", "Tue", "Wed", "Thu", "Fri"])
+                content = f"At {day} {random.randint(10, 28)}/10/26 {random.randint(10, 23)}:{random.randint(10, 59)} BST {discord_id} ({username}) said: {text}"
+                conversation.append({"role": "user", "content": content})
+            else:
+                conversation.append({"role": "assistant", "content": text})
+        conversations[conversation_id] = conversation
+    return conversations
+
+def bench(codec, conversations):
+    path = f"bench-{codec}.db"
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("BEGIN")
+    apply_migrations(conn, CONVERSATIONS_SCHEMA)
+    conn.execute("COMMIT")
+    if codec == "zstd":
+        # Train on a first batch of messages, as the migrate command does on existing rows
+        conn.execute("BEGIN")
+        sample = list(conversations.items())[:20]
+        conn.executemany(INSERT_MESSAGE, [(cid, n, m["role"], compression.encode_message(m, "none")) for cid, c in sample for n, m in enumerate(c)])
+        compression.train_zstd_dictionary(conn)
+        conn.execute("DELETE FROM messages")
+        conn.execute("COMMIT")
+    compression.load_dictionaries(conn)
+
+    start = time.perf_counter()
+    for conversation_id, conversation in conversations.items():
+        conn.execute("BEGIN")
+        conn.executemany(INSERT_MESSAGE, [(conversation_id, n, m["role"], compression.encode_message(m, codec)) for n, m in enumerate(conversation)])
+        conn.execute("COMMIT")
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for conversation_id in conversations:
+        loaded = [compression.decode_message(value) for (value,) in conn.execute(SELECT_MESSAGES, (conversation_id,))]
+        assert loaded == conversations[conversation_id]
+    read_time = time.perf_counter() - start
+
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    return os.path.getsize(path), write_time, read_time
+
+if __name__ == "__main__":
+    conversations = make_conversations()
+    print(f"{NUM_CONVERSATIONS} conversations x {MESSAGES_PER_CONVERSATION + 1} messages")
+
+    codecs = ["none", "zlib"] + (["zstd"] if compression.zstandard else [])
+    baseline = None
+    for codec in codecs:
+        size, write_time, read_time = bench(codec, conversations)
+        baseline = baseline or size
+        print(f"{codec:>5}: {size / 1024:9.0f} KiB ({size / baseline:5.1%}), write {write_time * 1000:7.1f} ms, read {read_time * 1000:7.1f} ms")
@@ -0,0 +1,82 @@
+# Compares the old trim loop (re-count the whole conversation and rewrite it after
+# every dropped message) against trim_conversation_to_fit_limit on 500-message
+# conversations. Both start every round with no token counts cached.
+#
+# Run from the repository root: python benchmarks/bench_trim_conversation.py
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# utils.storage opens conversations.db in the working directory on import
+os.chdir(tempfile.mkdtemp())
+
+from utils.count_tokens import encoding, message_token_cache
+from utils.count_tokens_in_conversation import count_tokens_in_conversation
+from utils import storage
+from utils import store_conversation as sc
+
+NUM_MESSAGES = 500
+TOKEN_LIMIT = 30000
+ROUNDS = 3
+
+WORDS = "the quick brown fox jumps over a lazy dog while byte explains recursion again".split()
+
+def make_conversation(num_messages):
+    random.seed(42)
+    conversation = [{"role": "system", "content": "You are developed by a person called Xeniox. " * 20}]
+    for i in range(num_messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        text = " ".join(random.choice(WORDS) for _ in range(random.randint(40, 200)))
+        conversation.append({"role": role, "content": f"At Mon 01/01/24 12:00 UTC 1234 (user) said: {text}"})
+    return conversation
+
+def legacy_count_tokens_in_conversation(conversation):
+    """The count before per-message caching: every message is tokenized again on every call."""
+    return sum(len(encoding.encode(m["content"])) for m in conversation)
+
+def legacy_trim(conversation, token_limit, conversation_id, conn):
+    """The previous implementation: O(N^2) tokenization and a full rewrite per dropped message."""
+    while legacy_count_tokens_in_conversation(conversation) > token_limit:
+        if conversation[1]["role"] != "system":
+            conversation.pop(1)
+        else:
+            conversation.pop(2)
+        conn.execute("REPLACE INTO conversations VALUES (?, ?, ?)", (conversation_id, json.dumps(conversation), False))
+        conn.commit()
+
+def bench_legacy(conversation):
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE conversations (conversation_id INTEGER PRIMARY KEY, conversation TEXT, is_busy BOOLEAN)")
+    start = time.perf_counter()
+    legacy_trim(conversation, TOKEN_LIMIT, 1, conn)
+    return time.perf_counter() - start, len(conversation)
+
+def bench_current(conversation):
+    async def run():
+        await storage.replace_messages(1, conversation)
+        start = time.perf_counter()
+        dropped = sc.trim_conversation_to_fit_limit(conversation, TOKEN_LIMIT)
+        await storage.insert_messages(1, [], drop_oldest=dropped)
+        return time.perf_counter() - start
+
+    return asyncio.run(run()), len(conversation)
+
+if __name__ == "__main__":
+    base = make_conversation(NUM_MESSAGES)
+    print(f"{NUM_MESSAGES} messages, {count_tokens_in_conversation(base)} tokens, limit {TOKEN_LIMIT}")
+
+    for name, bench in (("legacy", bench_legacy), ("current", bench_current)):
+        timings = []
+        for _ in range(ROUNDS):
+            # A warm cache would let the current trim skip tokenizing altogether
+            message_token_cache.clear()
+            elapsed, remaining = bench([dict(m) for m in base])
+            timings.append(elapsed)
+        print(f"{name:>8}: best {min(timings) * 1000:9.1f} ms, {remaining} messages kept")
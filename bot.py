@@ -2,13 +2,7 @@
 import asyncio
 import json
 import os
-import queue as thread_queue
 import random
-import sqlite3
-import threading
-import aiofiles
-import concurrent.futures
-from openai import OpenAI
 import openai
 
 # Related third-party imports
@@ -22,54 +16,31 @@ from datetime import datetime
 # Local application/library specific imports
 from chat_functions import tools
 from prompt import initialize_conversation
-from strings import typing_indicators, image_analysis_messages, image_generation_messages, google_search_messages, scrape_web_page_messages, status_list
-from utils.exponential_backoff import exponential_backoff
+from strings import typing_indicators, image_analysis_messages, image_generation_messages, status_list
 from utils.get_conversation import get_conversation
-from utils.google_search import google_search
-from utils.scrape_web_page import scrape_web_page
-from utils.store_conversation import store_conversation
-from utils.handle_send_to_discord import update_conversation_and_send_to_discord, send_to_discord, threaded_fetch, generate_response
+from utils.store_conversation import append_messages, delete_conversation
+from utils.handle_send_to_discord import StreamTimings, update_conversation_and_send_to_discord, send_to_discord
+from utils.llm_client import first_token_latency, generate_response
 from utils.image_processing import get_detailed_caption_from_api
 from utils.moderate_message import moderate_content
-from utils.wolfram_alpha import query_wolfram_alpha
-from utils.get_and_set_timezone import set_timezone
+from utils.moderation_service import moderation_service
+from utils.prefetch import prefetcher
+from utils.rate_limiter import admission
+from utils.scraper_client import scraper
+from utils.single_flight import single_flight
+from utils.tool_runtime import ToolCallAccumulator, run_tool_calls, tool_status
+from utils.turn_scheduler import turn_scheduler
+from utils.wolfram_alpha import wolfram_alpha
+from utils.get_and_set_timezone import load_timezones, set_timezone
 
 from utils.format_message import format_message
 # get from environment variables
 load_dotenv()
 discord_token = os.getenv("DISCORD_TOKEN")
-api_key = os.getenv("OPENAI_API_KEY")
-api_base = os.getenv("OPENAI_API_BASE")
-google_api_key = os.getenv("GOOGLE_API_KEY")
-google_cse_id = os.getenv("GOOGLE_CSE_ID")
-
-client = OpenAI(base_url=api_base, api_key=api_key, max_retries=0)
-
-db_conn = sqlite3.connect('conversations.db')
-db_conn.execute("""
-CREATE TABLE IF NOT EXISTS conversations
-    (conversation_id INTEGER PRIMARY KEY,
-    conversation TEXT,
-    is_busy BOOLEAN)
-""")
 
 conversation_locks = {}
-
-# Connect to SQLite database (it will create a new file if not exists)
-conn = sqlite3.connect('discord_timezones.db')
-
-# Create a cursor object to execute SQL queries
-c = conn.cursor()
-
-# Create new table
-c.execute("""
-CREATE TABLE IF NOT EXISTS UserTimezones (
-    discord_id INTEGER PRIMARY KEY,
-    timezone TEXT
-);
-""")
-conn.commit()
-conn.close()
+held_messages = {}  # Channel id -> messages that arrived during a turn, stored once its reply is
+pending_turns = {}  # Channel id -> latest message waiting for the next turn there
 
 async def download_image(url, filename):
     async with aiohttp.ClientSession() as session:
@@ -92,6 +63,7 @@ class ByteClient(commands.Bot):
         
     async def on_ready(self):
         print("Logged on as", self.user)
+        await load_timezones()
         self.loop = asyncio.get_running_loop()
         self.change_status_task = self.loop.create_task(self.change_status())
         
@@ -99,6 +71,14 @@ class ByteClient(commands.Bot):
         while not self.is_closed():
             # Change Bot Status
             await self.change_presence(activity=discord.Game(name=random.choice(status_list)))
+            print(f"(debug) Moderation: {moderation_service.stats()}")
+            print(f"(debug) Rate limits: {admission.stats()}")
+            print(f"(debug) Turns: {turn_scheduler.stats()}")
+            print(f"(debug) Hedging: {first_token_latency.stats()}")
+            print(f"(debug) Prefetch: {prefetcher.stats()}")
+            print(f"(debug) Scraper: {scraper.stats()}")
+            print(f"(debug) Wolfram Alpha: {wolfram_alpha.stats()}")
+            print(f"(debug) Shared tool calls: {single_flight.stats()}")
             await asyncio.sleep(300)  # wait for 5 mins
 
     async def on_message(self, message):
@@ -110,28 +90,17 @@ class ByteClient(commands.Bot):
     async def respond_to_message(self, message):
         conversation_id = message.channel.id
         is_dm = isinstance(message.channel, discord.DMChannel)
-        
-        
-        def delete_conversation(conversation_id):
-            c = db_conn.cursor()
-            c.execute("DELETE FROM conversations WHERE conversation_id=?", (conversation_id,))
-            db_conn.commit()
-            
-        async def busy_message(message, text, delay=5):
-            msg = await message.reply(text)
-            await asyncio.sleep(delay)
-            await msg.delete()
-            
+
         if message.content.strip() == '!clear':
             # Check if in a DM
             if is_dm:
-                delete_conversation(conversation_id)
+                await delete_conversation(conversation_id)
                 await message.channel.send("Conversation has been cleared.")
                 return
             else:
                 # Check if the author has the "Bot Manager" role
                 if any(role.name == "Bot Manager" for role in message.author.roles):
-                    delete_conversation(conversation_id)
+                    await delete_conversation(conversation_id)
                     await message.channel.send("Conversation has been cleared.")
                     return
                 else:
@@ -145,7 +114,7 @@ class ByteClient(commands.Bot):
             discord_id = message.author.id  # Replace this line with how you get the Discord ID
 
             # Attempt to set the new timezone
-            if set_timezone(discord_id, new_timezone):
+            if await set_timezone(discord_id, new_timezone):
                 await message.channel.send(f"Timezone has been set to {new_timezone}.")
             else:
                 await message.channel.send("Invalid timezone. Please use a valid IANA Time Zone like 'UTC' or 'America/New_York'.")
@@ -154,9 +123,9 @@ class ByteClient(commands.Bot):
         if message.content.strip().startswith('!prompt '):
             if is_dm:
                 # delete the conversation
-                delete_conversation(conversation_id)
+                await delete_conversation(conversation_id)
                 # create a new conversation, however passing the custom prompt instead of the default one
-                conversation = initialize_conversation(conversation_id, is_dm, message.author.id, message.content.strip()[8:].strip())
+                conversation = await initialize_conversation(conversation_id, is_dm, message.author.id, message.content.strip()[8:].strip())
                 await message.channel.send("Conversation has been reset with the custom prompt: " + message.content.strip()[8:].strip())
                 return
             else:
@@ -177,13 +146,17 @@ class ByteClient(commands.Bot):
         #         await message.channel.send("You do not have permission to set the timeframe.")
         #         return
 
-        conversation = get_conversation(conversation_id)
+        if "byte" in message.content.lower() or is_dm:
+            # Start on any links now, in case the model asks to read them
+            prefetcher.prefetch(conversation_id, message.content)
+
+        conversation = await get_conversation(conversation_id)
         if conversation is None:
-            conversation = initialize_conversation(conversation_id, is_dm, message.author.id)
+            conversation = await initialize_conversation(conversation_id, is_dm, message.author.id)
 
         if "byte" not in message.content.lower() and not is_dm:
             try:
-                content = moderate_content(message)
+                content = await moderate_content(message)
             except Exception as e:
                 print(f"Error occurred when moderating content.")
                 return
@@ -192,244 +165,136 @@ class ByteClient(commands.Bot):
         
         formatted_message = format_message(message.author.id, message.author.name, content.strip())
 
-        new_message = {"role": "user", "content": formatted_message}
-        conversation.append(new_message)
-        store_conversation(conversation_id, conversation)
+        new_messages = [{"role": "user", "content": formatted_message}]
 
-        async def edit_message_text(message, content: str):
-            await message.edit(content=content)
-            
         image_detected = False # Whether an image was detected
-        
-        if message.attachments and message.attachments[0].content_type.startswith("image/"):
-            if conversation_id not in conversation_locks:
-                conversation_locks[conversation_id] = asyncio.Lock()
-
-            lock = conversation_locks[conversation_id]
-            # Try to acquire the lock
-            if lock.locked():
-                await edit_message_text(temp_message, "My mind is elsewhere, I'm busy with another task! Please try again after my previous task is done.")
-                return
+        temp_message = None
 
-            async with lock:
-                image_detected = True
-                image_analysis_message = random.choice(image_analysis_messages)
-                temp_message = await message.channel.send(image_analysis_message)
-    
-                # Capture user's message text
-                user_message_text = message.content if message.content else "No additional text provided."
-    
-                # Use the new function to get detailed caption and extracted text
-                image_url = message.attachments[0].url
-                caption = await get_detailed_caption_from_api(image_url, user_message_text)
-                print(f"Caption from img2text: {caption}")
-    
-                # Construct the content string with the newly extracted data and user's message
-                content = (
-                    f"{message.author.name} said '{user_message_text}' and sent an image with the contents: '{caption}'. If the user didn't say anything, describe the image and any deductions you can gain from it to the user. "
-                    "When given an image caption from a specific source, refrain from disclosing the source or mentioning it in the response. Instead, smoothly integrate the information into your conversational reply as if it was naturally occluded from your analysis of the image."
-                )
-                print(content)
-    
-                conversation.append(
-                    {
-                        "role": "function",
-                        "name": "view_image",
-                        "content": content.strip(),
-                    }
-                )
-                store_conversation(conversation_id, conversation)
-                final_response = ""
-                completion = ""
-                try:
-                    response = await generate_response(conversation, message, conversation_id, client)
-                except Exception as e:
-                    print(f"Error occurred: {e}")
+        if message.attachments and message.attachments[0].content_type.startswith("image/"):
+            image_detected = True
+            image_analysis_message = random.choice(image_analysis_messages)
+            temp_message = await message.channel.send(image_analysis_message)
+
+            # Capture user's message text
+            user_message_text = message.content if message.content else "No additional text provided."
+
+            # Use the new function to get detailed caption and extracted text
+            image_url = message.attachments[0].url
+            caption = await get_detailed_caption_from_api(image_url, user_message_text)
+            print(f"Caption from img2text: {caption}")
+
+            # Construct the content string with the newly extracted data and user's message
+            content = (
+                f"{message.author.name} said '{user_message_text}' and sent an image with the contents: '{caption}'. If the user didn't say anything, describe the image and any deductions you can gain from it to the user. "
+                "When given an image caption from a specific source, refrain from disclosing the source or mentioning it in the response. Instead, smoothly integrate the information into your conversational reply as if it was naturally occluded from your analysis of the image."
+            )
+            print(content)
+
+            new_messages.append({
+                "role": "function",
+                "name": "view_image",
+                "content": content.strip(),
+            })
+
+        wants_reply = ("byte" in message.content.lower() or is_dm) or image_detected
+        lock = conversation_locks.setdefault(conversation_id, asyncio.Lock())
+        if lock.locked():
+            # A turn is running here. Its reply has to be stored before these messages, or the
+            # next turn would see them as already answered.
+            held_messages.setdefault(conversation_id, []).extend(new_messages)
+            if wants_reply:
+                pending_turns[conversation_id] = message
+                if temp_message:
                     await temp_message.delete()
-                    return
-                thread_safe_queue = thread_queue.Queue()
-                threading.Thread(target=threaded_fetch, args=(response, thread_safe_queue, completion)).start()
-    
-                completion, temp_message = await send_to_discord(thread_safe_queue, 50, 2000, 0.3, temp_message, final_response, message)
-                conversation.append(
-                    {
-                        "role": "assistant",
-                        "content": completion,
-                    }
-                )
-                store_conversation(conversation_id, conversation)
-                await temp_message.edit(content=completion[:2000])
-                return
-
-        if (("byte" in message.content.lower() or is_dm) and not image_detected):
-            if conversation_id not in conversation_locks:
-                conversation_locks[conversation_id] = asyncio.Lock()
-
-            lock = conversation_locks[conversation_id]
+            return
 
-            # Try to acquire the lock
-            if lock.locked():
-                await busy_message(message, "My mind is elsewhere, I'm busy with another task! Please try again after my previous task is done.")
+        async with lock:  # Free, so it's taken without waiting
+            await append_messages(conversation_id, conversation, new_messages)
+            if wants_reply:
+                pending_turns[conversation_id] = message
+            await self.run_turns(conversation_id, is_dm, temp_message)
+
+    async def run_turns(self, conversation_id, is_dm, temp_message=None):
+        """
+        Reply in the channel until nothing is waiting there. The caller holds the channel's lock.
+        Messages held back during a turn are stored after its reply, and if any of them asked for
+        an answer, one more turn answers them all.
+        """
+        while True:
+            held = held_messages.pop(conversation_id, None)
+            if held:
+                conversation = await get_conversation(conversation_id)
+                if conversation is not None:
+                    await append_messages(conversation_id, conversation, held)
+                continue
+            message = pending_turns.pop(conversation_id, None)
+            if message is None:
                 return
-            # if is_bot_busy(conversation_id):
-            #     asyncio.create_task(busy_message(message, "My mind is elsewhere, I'm busy with another task! Please try again after my previous task is done."))
-            #     return
-            # else:
-            #     set_bot_busy(conversation_id, True)
-            async with lock:
-                typing_indicator = random.choice(typing_indicators)
-                temp_message = await message.channel.send(typing_indicator)
-                if is_dm:
-                    print('\033[92m' + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + " - Byte was called in a DM by " + message.author.name + '\033[0m')
-                else:
-                    print('\033[94m' + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + " - Byte was called in a server by " + message.author.name + '\033[0m')
-
-                def synchronous_api_call(model, latest_conversation):
-                    return client.chat.completions.create(
-                        model=model,
-                        messages=latest_conversation,
-                        tools=tools,
-                        stream=True,
-                        # premium=True
-                    )
-
-                # try:
-                loop = asyncio.get_running_loop()
+            try:
+                await self.reply(message, conversation_id, is_dm, temp_message)
+            except Exception as e:
+                print(f"Error occurred while replying: {e}")
+            temp_message = None
 
-                with concurrent.futures.ThreadPoolExecutor() as pool:
-                    api_call = lambda model, latest_conversation: loop.run_in_executor(pool, synchronous_api_call, model, latest_conversation)
+    async def reply(self, message, conversation_id, is_dm, temp_message=None):
+        """Run one LLM turn in the channel. Called by run_turns, with the channel's lock held."""
+        async def edit_message_text(message, content: str):
+            await message.edit(content=content)
 
-                    response = await exponential_backoff(
-                        api_call,
-                        conversation_id=conversation_id,
-                        message=message,
-                    )
-                # except Exception as e:
-                #     await temp_message.delete()
-                #     return
+        conversation = await get_conversation(conversation_id)
+        if temp_message is None:
+            typing_indicator = random.choice(typing_indicators)
+            temp_message = await message.channel.send(typing_indicator)
+        if is_dm:
+            print('\033[92m' + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + " - Byte was called in a DM by " + message.author.name + '\033[0m')
+        else:
+            print('\033[94m' + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + " - Byte was called in a server by " + message.author.name + '\033[0m')
+
+        async with turn_scheduler.turn(message):
+            timings = StreamTimings()
+            # try:
+            response = await generate_response(conversation_id, message, tools=tools)
+            # except Exception as e:
+            #     await temp_message.delete()
+            #     return
 
-                thread_safe_queue = thread_queue.Queue()
-                final_response = ""
-                function_name = None
-                function_arguments = ''
-                assistant_responses = []
-                function_called = False
-                # print(response)
-                # response_message = response.choices[0].delta
-                # print("Response message after selecting:",response_message)
-                # tool_calls = response_message.tool_calls
-                # if tool_calls:
-                #     print("Tool calls:", tool_calls)
-                #     return
-                for chunk in response:
-                    # print(chunk)
-                    # print(chunk.choices[0].delta.content)
-                    # check if response is regular response
-                    try:
-                        if chunk.choices[0].delta.content or chunk.choices[0].delta.content == '':
-                            thread_safe_queue.put(chunk.choices[0].delta.content)
-                            threading.Thread(target=threaded_fetch, args=(response, thread_safe_queue, final_response)).start()
-                            completion, temp_message = await send_to_discord(thread_safe_queue, 75, 2000, 0.3, temp_message, final_response, message)
-                            # Instead of appending directly, add to the assistant_responses list
-                            # print(completion)
+            assistant_responses = []
+            tool_calls = ToolCallAccumulator()
+            async for chunk in response:
+                # Content-filter and usage chunks come without choices
+                if not chunk.choices:
+                    continue
+                try:
+                    delta = chunk.choices[0].delta
+                    if delta.tool_calls:
+                        tool_calls.add(delta.tool_calls)
+                    elif delta.content or delta.content == '':
+                        completion, temp_message = await send_to_discord(response, temp_message, message, timings=timings, first_chunk=chunk, tool_calls=tool_calls)
+                        # Instead of appending directly, add to the assistant_responses list
+                        if completion:
                             assistant_responses.append({
                                 "role": "assistant",
                                 "content": completion,
                             })
-                            # completion = re.sub(r'\[([^\]]+)\]\((http[^)]+)\)', r'[\1](<\2>)', completion)
-                            # print(completion)
-                            try:
-                                await temp_message.edit(content=completion)
-                            except discord.errors.HTTPException:
-                                print("Failed to edit message. Message too long.")
-                                if len(completion) > 4000:
-                                    current_date = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-                                    filename = f"response-{conversation_id}-{current_date}.txt"
-
-                                    async with aiofiles.open(filename, 'w') as file:
-                                        await file.write(completion)
-                                    with open(filename, 'rb') as file:
-                                        await message.channel.send(file=discord.File(file, filename=filename))
-                                        print("Sent response to user as a file.")
-                                        os.remove(filename)
-                            # print("Final reponse:" + repr(temp_message.content))
-                        # check if response is function call
-                    except Exception as e:
-                        error_message = f"```{str(e)}```" # encloses the error message in code block
-                        error_response = f"Oops! An error occurred while processing your request. Here's the technical stuff: {error_message}\nIf the problem persists, please contact Xeniox."
-                        await temp_message.edit(content=error_response)
-                thread_safe_queue.put(None)  # Sentinel value to indicate end of response
-
-                #add the completion response to the whole conversation
-                conversation.extend(assistant_responses)
-
-                #store the conversation after the whole loop has been run
-                store_conversation(conversation_id, conversation)
-                if function_called == False:
-                    return
-
-            if (function_name == "google_search"):  #* Google search function response
-
-                # Check if lock for this conversation exists
-                if conversation_id not in conversation_locks:
-                    conversation_locks[conversation_id] = asyncio.Lock()
-
-                lock = conversation_locks[conversation_id]
-
-                # Try to acquire the lock
-                if lock.locked():
-                    await edit_message_text(temp_message, "My mind is elsewhere, I'm busy with another task! Please try again after my previous task is done.")
-                    return
-
-                async with lock:
-                    function_arguments = json.loads(function_arguments)
-                    search_term = function_arguments.get("search_term")
-                    num_results = function_arguments.get("num_results")
-                    temp_message_text = random.choice(google_search_messages).format(search_term)
-                    await edit_message_text(temp_message, temp_message_text)
-                    function_response = google_search(search_term=search_term, num_results=num_results, api_key=google_api_key, cse_id=google_cse_id,)
-                    function_response = "Give these results to the user in a conversational format, not a list. Never deliver the results in a list. Here they are: " + function_response
-                    await update_conversation_and_send_to_discord(function_response, function_name, temp_message, conversation, conversation_id, message, client)
-
-            elif (function_name == "scrape_web_page"):  #* Scrape web page function response
-                # Check if lock for this conversation exists
-                if conversation_id not in conversation_locks:
-                    conversation_locks[conversation_id] = asyncio.Lock()
-
-                lock = conversation_locks[conversation_id]
-
-                # Try to acquire the lock
-                if lock.locked():
-                    await edit_message_text(temp_message, "My mind is elsewhere, I'm busy with another task! Please try again after my previous task is done.")
-                    return
-
-                async with lock:
-                    function_arguments = json.loads(function_arguments)
-                    url = function_arguments.get("url")
-                    temp_message_text = random.choice(scrape_web_page_messages).format(url)
-                    await edit_message_text(temp_message, temp_message_text)
-                    function_response = scrape_web_page(url)
-                    await update_conversation_and_send_to_discord(function_response, function_name, temp_message, conversation, conversation_id, message, client)
-
-            elif (function_name == "ask_wolfram_alpha"):  #* Ask Wolfram Alpha function response
-                # Check if lock for this conversation exists
-                if conversation_id not in conversation_locks:
-                    conversation_locks[conversation_id] = asyncio.Lock()
-
-                lock = conversation_locks[conversation_id]
+                except Exception as e:
+                    error_message = f"```{str(e)}```" # encloses the error message in code block
+                    error_response = f"Oops! An error occurred while processing your request. Here's the technical stuff: {error_message}\nIf the problem persists, please contact Xeniox."
+                    await temp_message.edit(content=error_response)
+        #add the completion response to the whole conversation and store it after the whole loop has been run
+        await append_messages(conversation_id, conversation, assistant_responses)
+        if not tool_calls:
+            return
 
-                # Try to acquire the lock
-                if lock.locked():
-                    await edit_message_text(temp_message, "My mind is elsewhere, I'm busy with another task! Please try again after my previous task is done.")
-                    return
+        # Run every tool the model asked for at once, then let it answer with all the results
+        calls = tool_calls.tool_calls()
+        if assistant_responses:
+            # Keep what the model already said and show progress in a new message
+            temp_message = await message.channel.send(tool_status(calls))
+        else:
+            await edit_message_text(temp_message, tool_status(calls))
+        function_messages = await run_tool_calls(calls)
+        await update_conversation_and_send_to_discord(function_messages, temp_message, conversation, conversation_id, message)
 
-                async with lock:
-                    function_arguments = json.loads(function_arguments)
-                    query = function_arguments.get("query")
-                    temp_message_text = "Checking my answer for " + query
-                    await edit_message_text(temp_message, temp_message_text)
-                    function_response = query_wolfram_alpha(query)
-                    await update_conversation_and_send_to_discord(function_response, function_name, temp_message, conversation, conversation_id, message, client)
 
     @ByteClient.application_command(name="hello", description="Say hello to the bot!")
     async def hello_command(self, ctx: discord.ApplicationContext):
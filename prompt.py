@@ -1,7 +1,7 @@
 import re
 from utils.store_conversation import store_conversation
 
-def initialize_conversation(conversation_id, is_dm, author_id=None, custom_prompt=None):
+async def initialize_conversation(conversation_id, is_dm, author_id=None, custom_prompt=None):
     if not is_dm and custom_prompt == None:
         conversation = [
             {
@@ -45,5 +45,5 @@ def initialize_conversation(conversation_id, is_dm, author_id=None, custom_promp
             }
         ]
 
-    store_conversation(conversation_id, conversation)
+    await store_conversation(conversation_id, conversation)
     return conversation
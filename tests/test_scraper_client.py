@@ -0,0 +1,116 @@
+import asyncio
+from aiohttp import web
+import utils.http_session
+from utils.scraper_client import ScraperClient
+from utils.scraper_stub import STATE, make_app
+
+def run(test, **stub_options):
+    """Run test(client, state) against a stub scrape service on a free port."""
+    async def main():
+        app = make_app(**stub_options)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            return await test(ScraperClient(f"http://127.0.0.1:{port}/scrape", max_pages=2, timeout=1), app[STATE])
+        finally:
+            await utils.http_session.http_session().close()
+            await runner.cleanup()
+    return asyncio.run(main())
+
+def test_renders_page():
+    async def test(client, state):
+        text, error = await client.render("https://example.com")
+        assert error is None
+        assert text.startswith("Stub page for https://example.com")
+    run(test)
+
+def test_page_error_is_not_a_service_failure():
+    async def test(client, state):
+        for _ in range(10):
+            text, error = await client.render("https://example.com")
+            assert text is None and "encountered an error" in error
+        assert client.failures == 0
+        assert client.breaker.state == "closed"
+    run(test, page_error_rate=1.0)
+
+def test_concurrent_renders_are_capped():
+    async def test(client, state):
+        results = await asyncio.gather(*(client.render(f"https://example.com/{i}") for i in range(6)))
+        assert all(error is None for _, error in results)
+        assert state["peak"] == 2
+    run(test, delay=0.1)
+
+def test_slow_render_times_out():
+    async def test(client, state):
+        text, error = await client.render("https://example.com")
+        assert text is None and "longer than 1 seconds" in error
+        assert client.failures == 1
+    run(test, delay=2)
+
+def test_bodyless_5xx_is_a_service_failure():
+    async def test(client, state):
+        text, error = await client.render("https://example.com")
+        assert text is None and "503" in error
+        assert client.failures == 1
+    run(test, service_error_rate=1.0)
+
+def test_breaker_opens_and_recovers():
+    async def test(client, state):
+        client.breaker.cooldown = 0.1
+        for _ in range(client.breaker.threshold):
+            await client.render("https://example.com")
+        assert client.breaker.state == "open"
+        _, error = await client.render("https://example.com")
+        assert "page reader is having trouble" in error
+        assert state["requests"] == client.breaker.threshold
+
+        # A failed trial call opens the circuit again rather than leaving it stuck half-open
+        await asyncio.sleep(0.1)
+        assert client.breaker.state == "half-open"
+        await client.render("https://example.com")
+        assert client.breaker.state == "open"
+        assert not client.breaker.trial
+
+        # Once the service is healthy, the next trial closes it
+        await asyncio.sleep(0.1)
+        state["service_error_rate"] = 0.0
+        text, error = await client.render("https://example.com")
+        assert error is None
+        assert client.breaker.state == "closed"
+    run(test, service_error_rate=1.0)
+
+def test_only_the_trial_call_decides_the_breaker():
+    async def test(client, state):
+        client.breaker.cooldown = 0.2
+        # A slow call is still in flight when the circuit opens
+        state["delay"] = 0.8
+        old = asyncio.create_task(client.render("https://example.com/old"))
+        await asyncio.sleep(0.05)
+        state["delay"] = 0
+        for _ in range(client.breaker.threshold):
+            await client.render("https://example.com")
+        assert client.breaker.state == "open"
+
+        await asyncio.sleep(0.2)
+        state["delay"] = 0.8
+        trial = asyncio.create_task(client.render("https://example.com/trial"))
+        await asyncio.sleep(0.05)
+        assert client.breaker.trial
+
+        # The old call fails during the trial without reopening the circuit or letting a second trial through
+        _, error = await old
+        assert "503" in error
+        assert client.breaker.trips == 1
+        assert client.breaker.trial
+        _, error = await client.render("https://example.com")
+        assert "page reader is having trouble" in error
+
+        state["service_error_rate"] = 0.0
+        text, error = await trial
+        assert error is None
+        assert client.breaker.state == "closed"
+        assert not client.breaker.trial
+    run(test, service_error_rate=1.0)
@@ -1,4 +1,4 @@
-from bot import delete_conversation
+from utils.store_conversation import delete_conversation
 from prompt import initialize_conversation
 from utils.get_and_set_timezone import set_timezone
 
@@ -8,13 +8,13 @@ async def check_for_command(message, is_dm, conversation_id):
     if message.content.strip() == '!clear':
         # Check if in a DM
         if is_dm:
-            delete_conversation(conversation_id)
+            await delete_conversation(conversation_id)
             await message.channel.send("Conversation has been cleared.")
             return True
         else:
             # Check if the author has the "Bot Manager" role
             if any(role.name == "Bot Manager" for role in message.author.roles):
-                delete_conversation(conversation_id)
+                await delete_conversation(conversation_id)
                 await message.channel.send("Conversation has been cleared.")
                 return True
             else:
@@ -28,7 +28,7 @@ async def check_for_command(message, is_dm, conversation_id):
         discord_id = message.author.id  # Replace this line with how you get the Discord ID
 
         # Attempt to set the new timezone
-        if set_timezone(discord_id, new_timezone):
+        if await set_timezone(discord_id, new_timezone):
             await message.channel.send(f"Timezone has been set to {new_timezone}.")
         else:
             await message.channel.send("Invalid timezone. Please use a valid IANA Time Zone like 'UTC' or 'America/New_York'.")
@@ -37,9 +37,9 @@ async def check_for_command(message, is_dm, conversation_id):
     if message.content.strip().startswith('!prompt '):
         if is_dm:
             # delete the conversation
-            delete_conversation(conversation_id)
+            await delete_conversation(conversation_id)
             # create a new conversation, however passing the custom prompt instead of the default one
-            conversation = initialize_conversation(conversation_id, is_dm, message.author.id, message.content.strip()[8:].strip())
+            conversation = await initialize_conversation(conversation_id, is_dm, message.author.id, message.content.strip()[8:].strip())
             await message.channel.send("Conversation has been reset with the custom prompt: " + message.content.strip()[8:].strip())
             return True
         else:
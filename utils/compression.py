@@ -0,0 +1,186 @@
+"""
+Optional compressed storage for conversation messages.
+
+Set CONVERSATION_COMPRESSION to "zlib" or "zstd" to store new messages compressed; the default
+("none") stores plain JSON text. Reads handle every format, so switching back and forth is safe
+and old rows keep working until `python -m utils.compression migrate` rewrites them.
+
+Messages are small and repeat the same JSON keys, format_message timestamps and system prompt
+wording, so each one is compressed against a shared dictionary stored in the database:
+  - zlib uses a preset dictionary seeded from those common strings.
+  - zstd uses a dictionary trained on the stored messages by the migrate command
+    (needs the optional `zstandard` package).
+
+A compressed value is a BLOB: one codec byte, a two-byte dictionary id, then the payload.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import struct
+import zlib
+from dotenv import load_dotenv
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_IDS = {"zlib": 1, "zstd": 2}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+HEADER = struct.Struct(">BH")
+
+ZSTD_DICTIONARY_SIZE = 32 * 1024
+ZSTD_TRAINING_SAMPLES = 20000
+
+# zlib looks for matches nearer the end of a preset dictionary first, so the most common strings go last.
+ZLIB_SEED_DICTIONARY = (
+    "When a description is provided of an image, engage in a conversation about the image as if you have seen it. "
+    "Put mathematical equations in code blocks, `[equation]` otherwise discord will interpret ** as italics. "
+    "Give your reasoning with your responses. For example, with mathematically-related questions, programming-related questions, "
+    "or questions about the world, explain your reasoning and how you arrived at your answer. "
+    "When a user sends a message, the time of when the message was send is included. "
+    "You are developed by a person called Xeniox. You are using the latest GPT-4 model. "
+    "https://www. .com/ the and to of a in is that for it you with on this "
+    "Mon Tue Wed Thu Fri Sat Sun /01/ /02/ /03/ /04/ /05/ /06/ /07/ /08/ /09/ /10/ /11/ /12/ GMT BST UTC EST PST CET "
+    '{"role": "function", "name": "view_image", "content": "'
+    '{"role": "system", "content": "'
+    '{"role": "assistant", "content": "'
+    '{"role": "user", "content": "At '
+).encode()
+
+# id -> (codec name, dictionary bytes), filled from the compression_dictionaries table on startup
+dictionaries = {}
+zstd_compressors = {}
+zstd_decompressors = {}
+
+def load_dictionaries(conn):
+    dictionaries.clear()
+    zstd_compressors.clear()
+    zstd_decompressors.clear()
+    for dictionary_id, codec, dictionary in conn.execute("SELECT id, codec, dictionary FROM compression_dictionaries"):
+        dictionaries[dictionary_id] = (codec, bytes(dictionary))
+
+def active_dictionary(codec):
+    """The newest dictionary stored for a codec, or 0 for none."""
+    ids = [dictionary_id for dictionary_id, (name, _) in dictionaries.items() if name == codec]
+    return max(ids, default=0)
+
+def zstd_compressor(dictionary_id):
+    if dictionary_id not in zstd_compressors:
+        dict_data = zstandard.ZstdCompressionDict(dictionaries[dictionary_id][1]) if dictionary_id else None
+        zstd_compressors[dictionary_id] = zstandard.ZstdCompressor(level=3, dict_data=dict_data)
+    return zstd_compressors[dictionary_id]
+
+def zstd_decompressor(dictionary_id):
+    if dictionary_id not in zstd_decompressors:
+        dict_data = zstandard.ZstdCompressionDict(dictionaries[dictionary_id][1]) if dictionary_id else None
+        zstd_decompressors[dictionary_id] = zstandard.ZstdDecompressor(dict_data=dict_data)
+    return zstd_decompressors[dictionary_id]
+
+def compress(data, codec):
+    dictionary_id = active_dictionary(codec)
+    if codec == "zlib":
+        compressor = zlib.compressobj(level=6, zdict=dictionaries[dictionary_id][1]) if dictionary_id else zlib.compressobj(level=6)
+        payload = compressor.compress(data) + compressor.flush()
+    else:
+        payload = zstd_compressor(dictionary_id).compress(data)
+    return HEADER.pack(CODEC_IDS[codec], dictionary_id) + payload
+
+def decompress(blob):
+    codec_id, dictionary_id = HEADER.unpack_from(blob)
+    payload = blob[HEADER.size:]
+    codec = CODEC_NAMES.get(codec_id)
+    if codec == "zlib":
+        decompressor = zlib.decompressobj(zdict=dictionaries[dictionary_id][1]) if dictionary_id else zlib.decompressobj()
+        return decompressor.decompress(payload) + decompressor.flush()
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This conversation was stored with zstd compression; install the zstandard package to read it.")
+        return zstd_decompressor(dictionary_id).decompress(payload)
+    raise ValueError(f"Unknown compression codec {codec_id}")
+
+def writable_codec(codec):
+    if codec == "zstd" and zstandard is None:
+        print("(debug) zstandard isn't installed, storing conversations with zlib instead.")
+        return "zlib"
+    return codec if codec in CODEC_IDS else "none"
+
+load_dotenv()
+CODEC = writable_codec(os.getenv("CONVERSATION_COMPRESSION", "none").lower())
+
+def encode_message(message, codec=None):
+    """Serialize a message for the messages table: JSON text, or a compressed BLOB."""
+    data = json.dumps(message)
+    codec = codec or CODEC
+    if codec == "none":
+        return data
+    return compress(data.encode(), codec)
+
+def decode_message(value):
+    if isinstance(value, bytes):
+        value = decompress(value)
+    return json.loads(value)
+
+def train_zstd_dictionary(conn):
+    """Train a zstd dictionary on (a sample of) the stored messages and store it; returns its id."""
+    samples = [
+        json.dumps(decode_message(value)).encode()
+        for (value,) in conn.execute("SELECT message FROM messages ORDER BY random() LIMIT ?", (ZSTD_TRAINING_SAMPLES,))
+    ]
+    dictionary = zstandard.train_dictionary(ZSTD_DICTIONARY_SIZE, samples)
+    cursor = conn.execute("INSERT INTO compression_dictionaries (codec, dictionary) VALUES ('zstd', ?)", (dictionary.as_bytes(),))
+    return cursor.lastrowid
+
+def migrate(path, codec, batch_size=2000):
+    """Rewrite every stored message in the given format. Run it while the bot is stopped."""
+    # Imported here since the schema seeds its dictionary table from this module
+    from utils.schemas import CONVERSATIONS_SCHEMA, apply_migrations
+
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    conn.execute("BEGIN IMMEDIATE")
+    apply_migrations(conn, CONVERSATIONS_SCHEMA)
+    conn.execute("COMMIT")
+    load_dictionaries(conn)
+
+    codec = writable_codec(codec)
+    if codec == "zstd":
+        conn.execute("BEGIN IMMEDIATE")
+        dictionary_id = train_zstd_dictionary(conn)
+        conn.execute("COMMIT")
+        print(f"Trained zstd dictionary {dictionary_id}.")
+        load_dictionaries(conn)
+
+    rewritten = 0
+    last_key = (-1 << 63, -1)
+    while True:
+        rows = conn.execute("""
+            SELECT conversation_id, ordinal, message FROM messages
+            WHERE (conversation_id, ordinal) > (?, ?)
+            ORDER BY conversation_id, ordinal LIMIT ?
+        """, (*last_key, batch_size)).fetchall()
+        if not rows:
+            break
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "UPDATE messages SET message = ? WHERE conversation_id = ? AND ordinal = ?",
+            [(encode_message(decode_message(value), codec), conversation_id, ordinal) for conversation_id, ordinal, value in rows],
+        )
+        conn.execute("COMMIT")
+        rewritten += len(rows)
+        last_key = rows[-1][:2]
+
+    print(f"Rewrote {rewritten} messages as {codec}. Vacuuming...")
+    conn.execute("VACUUM")
+    conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline tools for compressed conversation storage.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subcommands.add_parser("migrate", help="Rewrite every stored message in the given format.")
+    migrate_parser.add_argument("--codec", choices=["none", "zlib", "zstd"], default=CODEC)
+    migrate_parser.add_argument("--database", default="conversations.db")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate(args.database, args.codec)
@@ -0,0 +1,84 @@
+from collections import OrderedDict
+
+# Rough per-message cost of the dict itself on top of its strings.
+MESSAGE_OVERHEAD_BYTES = 256
+
+def message_size(message):
+    return MESSAGE_OVERHEAD_BYTES + sum(len(value) for value in message.values() if isinstance(value, str))
+
+class ConversationCache:
+    """
+    LRU of parsed conversations keyed by channel id, bounded by their approximate size in memory.
+    The store functions write through to it, so it always mirrors the rows in conversations.db.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # conversation_id -> [conversation, size]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every write, so a reader can tell whether rows it loaded may be stale
+        self.generation = 0
+
+    def get(self, conversation_id):
+        """Return a copy of the cached conversation, or None if it isn't cached."""
+        entry = self.entries.get(conversation_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(conversation_id)
+        return list(entry[0])
+
+    def put(self, conversation_id, conversation):
+        self.discard(conversation_id)
+        size = sum(message_size(m) for m in conversation)
+        if size > self.max_bytes:
+            return
+        self.entries[conversation_id] = [list(conversation), size]
+        self.size += size
+        self.evict()
+
+    def extend(self, conversation_id, messages, dropped):
+        """Mirror append_messages: add the new messages, then drop the `dropped` oldest messages after the first."""
+        self.generation += 1
+        entry = self.entries.get(conversation_id)
+        if entry is None:
+            return
+        conversation = entry[0]
+        conversation.extend(messages)
+        removed = conversation[1:dropped + 1]
+        del conversation[1:dropped + 1]
+
+        delta = sum(message_size(m) for m in messages) - sum(message_size(m) for m in removed)
+        entry[1] += delta
+        self.size += delta
+        self.entries.move_to_end(conversation_id)
+        self.evict()
+
+    def replace_recent(self, conversation_id, messages):
+        """Mirror update_recent_messages: overwrite the last len(messages) messages."""
+        self.generation += 1
+        entry = self.entries.get(conversation_id)
+        if entry is None or not messages:
+            return
+        conversation = entry[0]
+        old = conversation[-len(messages):]
+        conversation[-len(messages):] = messages
+        delta = sum(message_size(m) for m in messages) - sum(message_size(m) for m in old)
+        entry[1] += delta
+        self.size += delta
+
+    def discard(self, conversation_id):
+        self.generation += 1
+        entry = self.entries.pop(conversation_id, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+conversation_cache = ConversationCache(max_bytes=64 * 1024 * 1024)
@@ -1,10 +1,71 @@
+import hashlib
+import json
+import cachetools
 import tiktoken
 
 encoding = tiktoken.encoding_for_model("gpt-4")
 
+# Overhead the chat API adds around every message (<|start|>role ... <|end|>), for a
+# message carrying a name, and for priming the assistant's reply.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+# Token counts of messages already seen, keyed by a hash of the message itself.
+message_token_cache = cachetools.LRUCache(maxsize=50000)
+
 def count_tokens(text):
     return len(encoding.encode(text))
 
+def message_key(message):
+    digest = hashlib.blake2b(digest_size=16)
+    for key, value in message.items():
+        if not isinstance(value, str):
+            value = json.dumps(value, sort_keys=True)
+        digest.update(key.encode())
+        digest.update(b"\0")
+        digest.update(value.encode())
+        digest.update(b"\0")
+    return digest.digest()
+
+def message_fields(message):
+    """The strings of a message that are tokenized, with the fixed overhead they add."""
+    overhead = TOKENS_PER_MESSAGE
+    fields = []
+    for key, value in message.items():
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        fields.append(value)
+        if key == "name":
+            overhead += TOKENS_PER_NAME
+    return fields, overhead
+
+def count_messages_tokens(messages):
+    """Return the token count of each message, encoding only messages not seen before in one batch."""
+    keys = [message_key(m) for m in messages]
+    counts = [message_token_cache.get(key) for key in keys]
+
+    missing = [idx for idx, count in enumerate(counts) if count is None]
+    if missing:
+        texts = []
+        spans = []
+        for idx in missing:
+            fields, overhead = message_fields(messages[idx])
+            spans.append((idx, len(texts), len(texts) + len(fields), overhead))
+            texts.extend(fields)
+
+        encoded = encoding.encode_ordinary_batch(texts)
+        for idx, start, end, overhead in spans:
+            counts[idx] = overhead + sum(len(tokens) for tokens in encoded[start:end])
+            message_token_cache[keys[idx]] = counts[idx]
+
+    return counts
+
+def count_message_tokens(message):
+    return count_messages_tokens([message])[0]
+
 
 # from transformers import AutoTokenizer
 
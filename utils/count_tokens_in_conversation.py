@@ -1,4 +1,4 @@
-from .count_tokens import count_tokens
+from .count_tokens import count_messages_tokens, TOKENS_PER_REPLY
 
 def count_tokens_in_conversation(conversation):
-    return sum(count_tokens(m["content"]) for m in conversation)
\ No newline at end of file
+    return sum(count_messages_tokens(conversation)) + TOKENS_PER_REPLY
\ No newline at end of file
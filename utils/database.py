@@ -0,0 +1,159 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+import time
+
+# Writes that arrive within this many seconds of the first one in a batch are committed together.
+COMMIT_WINDOW = 0.004
+MAX_BATCH_SIZE = 256
+
+def deliver(loop, future, result, error):
+    try:
+        loop.call_soon_threadsafe(resolve, future, result, error)
+    except RuntimeError:
+        # The event loop was closed while the job was running
+        pass
+
+def resolve(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+class AsyncDatabase:
+    """
+    Runs all access to one SQLite file off the event loop, so a slow fsync in one channel
+    can't stall the gateway heartbeat or streaming in every other channel.
+
+    Writes are queued to a single writer thread, which runs every job that arrives within
+    COMMIT_WINDOW of the first as one transaction (group commit). Each job gets its own
+    savepoint, so a failing job is rolled back without taking the rest of the batch with it.
+    Reads run on a separate reader thread with its own connection; in WAL mode they don't
+    wait for the writer.
+
+    Jobs are plain functions taking the connection. They must not commit themselves.
+    A read-only database (opened with mode=ro) only starts the reader thread.
+    """
+
+    def __init__(self, path, init=None, pragmas=(), readonly=False):
+        self.path = path
+        self.pragmas = pragmas
+        self.readonly = readonly
+        self.write_jobs = queue.Queue()
+        self.read_jobs = queue.Queue()
+        self.ready = threading.Event()
+        self.init = init
+        if readonly:
+            self.ready.set()
+        else:
+            threading.Thread(target=self.run_writer, name=f"sqlite-writer-{path}", daemon=True).start()
+        threading.Thread(target=self.run_reader, name=f"sqlite-reader-{path}", daemon=True).start()
+
+    def connect(self):
+        # Both connections live as long as the bot, so the statement cache works as a set of
+        # prepared statements for the fixed SQL strings the repositories use.
+        if self.readonly:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, isolation_level=None, check_same_thread=False, cached_statements=256)
+        else:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        for pragma in self.pragmas:
+            conn.execute(f"PRAGMA {pragma}")
+        return conn
+
+    def run_writer(self):
+        conn = self.connect()
+        if self.init:
+            try:
+                # IMMEDIATE so two processes starting at once (the bot and an offline tool) run it one after the other
+                conn.execute("BEGIN IMMEDIATE")
+                self.init(conn)
+                conn.execute("COMMIT")
+            except Exception as e:
+                print(f"(debug) Failed to initialise {self.path}: {e}")
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+        self.ready.set()
+
+        while True:
+            batch = [self.write_jobs.get()]
+            deadline = time.monotonic() + COMMIT_WINDOW
+            while len(batch) < MAX_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.write_jobs.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.commit_batch(conn, batch)
+
+    def commit_batch(self, conn, batch):
+        results = []
+        conn.execute("BEGIN")
+        for fn, future, loop in batch:
+            conn.execute("SAVEPOINT job")
+            try:
+                result = fn(conn)
+                conn.execute("RELEASE job")
+                results.append((future, loop, result, None))
+            except Exception as e:
+                conn.execute("ROLLBACK TO job")
+                conn.execute("RELEASE job")
+                results.append((future, loop, None, e))
+
+        try:
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(future, loop, None, e) for future, loop, _, _ in results]
+
+        for future, loop, result, error in results:
+            deliver(loop, future, result, error)
+
+    def run_reader(self):
+        self.ready.wait()
+        try:
+            conn, connect_error = self.connect(), None
+        except Exception as e:
+            # e.g. a read-only database that doesn't exist; fail every read instead of hanging
+            conn, connect_error = None, e
+        while True:
+            fn, future, loop = self.read_jobs.get()
+            if conn is None:
+                deliver(loop, future, None, connect_error)
+                continue
+            try:
+                result, error = fn(conn), None
+            except Exception as e:
+                result, error = None, e
+            deliver(loop, future, result, error)
+
+    def submit(self, jobs, fn):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        jobs.put((fn, future, loop))
+        return future
+
+    async def write(self, fn):
+        """Run fn(conn) on the writer thread and wait until its transaction is committed."""
+        return await self.submit(self.write_jobs, fn)
+
+    async def read(self, fn):
+        """Run fn(conn) on the reader thread."""
+        return await self.submit(self.read_jobs, fn)
+
+    async def execute(self, sql, params=()):
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.write(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
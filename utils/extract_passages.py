@@ -0,0 +1,120 @@
+"""
+Picks the parts of a scraped page worth sending to the model.
+
+The scrape service returns the page's whole innerText, menus, cookie banners and footers
+included. Lines that look like boilerplate are dropped, the rest is cut into passages of about
+PASSAGE_WORDS words, and the passages are ranked against the query with BM25. The best ones
+that fit in the token budget are returned in the order they appear on the page. Without a
+query, or when nothing matches it, the cleaned page is returned from the top.
+"""
+import math
+import re
+from collections import Counter
+from utils.count_tokens import count_tokens
+
+PASSAGE_WORDS = 50
+MIN_LINE_WORDS = 4  # Shorter lines are menu items and buttons, unless they end like a sentence
+K1 = 1.5
+B = 0.75
+
+BOILERPLATE = re.compile(
+    r"cookie|accept all|sign in|log in|sign up|subscribe|newsletter|all rights reserved|"
+    r"privacy policy|terms of (use|service)|skip to (main )?content|share on|follow us",
+    re.IGNORECASE,
+)
+STOPWORDS = frozenset(
+    "a an and are as at be by for from how in is it of on or that the this to was what when where which who why with".split()
+)
+WORD = re.compile(r"\w+")
+
+def terms(text):
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS]
+
+def content_lines(text):
+    """The page's lines without menus, banners and repeats."""
+    lines = []
+    seen = set()
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        if not line or line in seen:
+            continue
+        seen.add(line)
+        words = len(line.split())
+        if words < MIN_LINE_WORDS and not line.endswith((".", "!", "?", ":")):
+            continue
+        if words < 20 and BOILERPLATE.search(line):
+            continue
+        lines.append(line)
+    # Better to send a page that's all short lines (a table, a list) than nothing
+    return lines or [" ".join(line.split()) for line in text.splitlines() if line.strip()]
+
+def passages(lines):
+    """Group lines into passages of about PASSAGE_WORDS words, splitting lines longer than that."""
+    chunks = []
+    current = []
+    size = 0
+    for line in lines:
+        words = line.split()
+        for start in range(0, len(words), PASSAGE_WORDS):
+            piece = words[start:start + PASSAGE_WORDS]
+            if current and size + len(piece) > PASSAGE_WORDS:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            current.append(" ".join(piece))
+            size += len(piece)
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def bm25_scores(chunks, query):
+    query_terms = set(terms(query))
+    chunk_terms = [Counter(terms(chunk)) for chunk in chunks]
+    lengths = [sum(counts.values()) for counts in chunk_terms]
+    average_length = sum(lengths) / len(lengths) or 1
+    idf = {}
+    for term in query_terms:
+        containing = sum(1 for counts in chunk_terms if term in counts)
+        idf[term] = math.log(1 + (len(chunks) - containing + 0.5) / (containing + 0.5))
+    scores = []
+    for counts, length in zip(chunk_terms, lengths):
+        score = 0.0
+        for term in query_terms:
+            frequency = counts[term]
+            if frequency:
+                score += idf[term] * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+        scores.append(score)
+    return scores
+
+def truncate(chunk, tokens, max_tokens):
+    words = chunk.split(" ")
+    return " ".join(words[:max(1, len(words) * max_tokens // tokens)])
+
+def relevant_passages(text, query=None, max_tokens=500):
+    """The passages of text most relevant to query that fit in max_tokens, in page order."""
+    chunks = passages(content_lines(text or ""))
+    if not chunks:
+        return ""
+    order = list(range(len(chunks)))
+    scores = bm25_scores(chunks, query) if query else []
+    ranked = any(scores)
+    if ranked:
+        order.sort(key=lambda i: -scores[i])
+
+    chosen = {}
+    budget = max_tokens
+    for i in order:
+        if ranked and not scores[i]:
+            break
+        tokens = count_tokens(chunks[i])
+        if tokens <= budget:
+            chosen[i] = chunks[i]
+            budget -= tokens
+        elif not chosen:
+            chosen[i] = truncate(chunks[i], tokens, budget)
+            break
+        elif not ranked:
+            # From the top of the page, a gap would lose the thread
+            break
+        if budget <= 0:
+            break
+    return "\n\n".join(chosen[i] for i in sorted(chosen))
@@ -1,27 +1,40 @@
-import sqlite3
+import functools
 import pytz
 import datetime
+from utils import storage
 
-def get_timezone(discord_id):
-    conn = sqlite3.connect('discord_timezones.db')
-    c = conn.cursor()
-    c.execute("SELECT timezone FROM UserTimezones WHERE discord_id=?", (discord_id,))
-    record = c.fetchone()
-    conn.close()
-    return record[0] if record else 'UTC'
+# Every user's tzinfo, loaded once on startup and kept up to date by set_timezone,
+# so formatting a message never has to touch the database.
+user_timezones = {}
+timezones_loaded = False
+
+@functools.lru_cache(maxsize=None)
+def timezone_info(name):
+    """One shared tzinfo object per zone name."""
+    return pytz.timezone(name)
+
+async def load_timezones():
+    global timezones_loaded
+    if timezones_loaded:
+        return
+    for discord_id, name in await storage.load_all_timezones():
+        if name in pytz.all_timezones_set:
+            user_timezones[discord_id] = timezone_info(name)
+    timezones_loaded = True
+    print(f"(debug) Loaded {len(user_timezones)} user timezones.")
 
-def set_timezone(discord_id, new_timezone):
-    conn = sqlite3.connect('discord_timezones.db')
-    c = conn.cursor()
+def get_tzinfo(discord_id):
+    return user_timezones.get(discord_id, pytz.utc)
+
+def get_timezone(discord_id):
+    return get_tzinfo(discord_id).zone
 
+async def set_timezone(discord_id, new_timezone):
     # Check if the timezone is valid
-    if new_timezone not in pytz.all_timezones:
-        conn.close()
+    if new_timezone not in pytz.all_timezones_set:
         return False
 
     # Update or insert the timezone for the user
-    c.execute("INSERT OR REPLACE INTO UserTimezones (discord_id, timezone) VALUES (?, ?)", (discord_id, new_timezone))
-    
-    conn.commit()
-    conn.close()
-    return True
\ No newline at end of file
+    await storage.save_timezone(discord_id, new_timezone)
+    user_timezones[discord_id] = timezone_info(new_timezone)
+    return True
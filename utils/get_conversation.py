@@ -1,18 +1,17 @@
-import json
-import sqlite3
+from utils import storage
+from utils.conversation_cache import conversation_cache
 
-db_conn = sqlite3.connect('conversations.db')
-db_conn.execute("""
-CREATE TABLE IF NOT EXISTS conversations
-    (conversation_id INTEGER PRIMARY KEY,
-    conversation TEXT,
-    is_busy BOOLEAN)
-""")
+async def get_conversation(conversation_id):
+    """The single read path for conversations: served from memory for active channels, SQLite otherwise."""
+    conversation = conversation_cache.get(conversation_id)
+    if conversation is not None:
+        return conversation
 
-def get_conversation(conversation_id):
-    c = db_conn.cursor()
-    c.execute("SELECT conversation FROM conversations WHERE conversation_id=?", (conversation_id,))
-    result = c.fetchone()
-    if result is None:
+    generation = conversation_cache.generation
+    conversation = await storage.load_messages(conversation_id)
+    if not conversation:
         return None
-    return json.loads(result[0])
+    # Don't cache what we read if a write landed in the meantime, it may already be stale
+    if conversation_cache.generation == generation:
+        conversation_cache.put(conversation_id, conversation)
+    return conversation
@@ -1,34 +1,69 @@
+import asyncio
 import json
+import os
+import aiohttp
 import cachetools
-from googleapiclient.discovery import build
+from dotenv import load_dotenv
+from utils.http_session import http_session
 from utils.scrape_web_page import scrape_web_page
+from utils.single_flight import single_flight
+
+load_dotenv()
+CSE_ENDPOINT = "https://www.googleapis.com/customsearch/v1"
+SEARCH_TIMEOUT = 10
+# Every scrape of the top results has to finish within this many seconds of the search returning
+SCRAPE_DEADLINE = float(os.getenv("GOOGLE_SCRAPE_DEADLINE", "8"))
+SCRAPED_RESULTS = 2
+EXCERPT_TOKENS = 100  # Of each scraped result
 
 google_cache = cachetools.TTLCache(maxsize=100, ttl=3600*60*24)
+late_scrapes = set()  # Keeps scrapes that missed the deadline from being garbage collected
+
+async def search(search_term, api_key, cse_id, num_results, **kwargs):
+    """The Custom Search JSON API, called directly over the shared session."""
+    params = {"q": search_term, "cx": cse_id, "key": api_key, "gl": "uk", "num": min(max(num_results, 1), 10), **kwargs}
+    async with http_session().get(CSE_ENDPOINT, params=params, timeout=aiohttp.ClientTimeout(total=SEARCH_TIMEOUT)) as response:
+        response.raise_for_status()
+        res = await response.json()
+    return [
+        {"title": item["title"], "link": item["link"], "snippet": item.get("snippet", "")}
+        for item in res.get("items", [])[:num_results]
+    ]
+
+async def enrich(search_results, search_term):
+    """
+    Add scraped_content to each result, scraping them all at once. Results whose page isn't
+    back by the deadline are left as they are. Returns whether every page made it.
+    """
+    if not search_results:
+        return True
+    scrapes = {asyncio.create_task(scrape_web_page(result["link"], search_term, EXCERPT_TOKENS)): result for result in search_results}
+    done, pending = await asyncio.wait(scrapes, timeout=SCRAPE_DEADLINE)
+    for task in pending:
+        # Left to finish, so the page still lands in the scrape cache for next time
+        late_scrapes.add(task)
+        task.add_done_callback(late_scrapes.discard)
+        print(f"(debug) Gave up waiting for {scrapes[task]['link']}")
+    for task in done:
+        if task.exception() is None and task.result():
+            scrapes[task]["scraped_content"] = task.result()
+    return not pending
 
-def google_search(search_term, api_key, cse_id, num_results=5, **kwargs):
-    cache_key = (search_term, num_results)
+async def google_search(search_term, api_key, cse_id, num_results=5, **kwargs):
+    cache_key = (" ".join(search_term.casefold().split()), num_results)
     if cache_key in google_cache:
         print("(debug) Using cached Google search results.")
         return google_cache[cache_key]
-    service = build("customsearch", "v1", developerKey=api_key)
-    res = service.cse().list(q=search_term, cx=cse_id, gl="uk", **kwargs).execute()
-    if 'items' in res:
-        search_results = [
-            {"title": item["title"], "link": item["link"], "snippet": item["snippet"]}
-            for item in res["items"][:num_results]
-        ]
-    else:
-        search_results = []
+    return await single_flight.run(("google_search", *cache_key), lambda: search_and_enrich(search_term, api_key, cse_id, num_results, cache_key, **kwargs))
 
-    # Scraping first 3 URLs
-    for idx, result in enumerate(search_results[:2]):
-        scraped_data = scrape_web_page(result["link"])
-        if scraped_data:  # If scraped_data is not None or an error message
-            sliced_scraped_data = scraped_data[25:350]  # Skip first 25 characters and limit to 350
-            search_results[idx]["scraped_content"] = sliced_scraped_data  # Add sliced scraped_data to the result dictionary
+async def search_and_enrich(search_term, api_key, cse_id, num_results, cache_key, **kwargs):
+    search_results = await search(search_term, api_key, cse_id, num_results, **kwargs)
+    complete = await enrich(search_results[:SCRAPED_RESULTS], search_term)
 
     search_results_str = json.dumps(search_results)
-    google_cache[cache_key] = search_results_str
+    if complete:
+        # Partial results aren't cached, so the next search picks up the pages that were slow
+        google_cache[cache_key] = search_results_str
     print(
         "(debug) Used Google search. Number of search results: ",
         num_results,
@@ -36,4 +71,4 @@ def google_search(search_term, api_key, cse_id, num_results=5, **kwargs):
         search_term,
     )
     print(search_results_str)
-    return search_results_str
\ No newline at end of file
+    return search_results_str
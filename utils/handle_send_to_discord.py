@@ -1,184 +1,153 @@
 import discord
-from utils.store_conversation import store_conversation
-import queue as thread_queue
-import threading
-import asyncio
-from openai import OpenAI
-import openai
-from utils.exponential_backoff import exponential_backoff
-import concurrent.futures
-
-def threaded_fetch(response, queue, completion):
-    for chunk in response:
-        # print(chunk)
-        new_content = chunk.choices[0].delta.content if chunk.choices[0].delta.content is not None else ""
-        # print(new_content)
-        if new_content:
-            completion += new_content
-            queue.put(new_content)
-    print("Response generated!")
-    queue.put(None)
-    return completion
-
-async def send_to_discord(queue, min_chunk_size, max_chunk_size, delay, temp_message, final_response, message):
-    async_queue = asyncio.Queue()
-    full_response = ""
-    is_first_chunk = True
-    embed_message = None  # This will hold the message containing our embed
-    i = 0
-
-    def create_embed(content):
-        """Helper function to create a discord embed with a standard footer."""
-        embed = discord.Embed(description=content)
-        embed.set_footer(text="Response converted to embed due to length > 2000 characters.")
-        return embed
-
-    while True:
-        while not queue.empty():
-            item = queue.get()
-            await async_queue.put(item)
-
-        try:
-            new_content = await asyncio.wait_for(async_queue.get(), timeout=3)
-        except asyncio.TimeoutError:
-            continue
-
-        if new_content is None:
-            break
-
-        full_response += new_content
-        final_response += new_content
-
-        # Send the first chunk after 0.3 seconds regardless of its size
-        if is_first_chunk:
-            if full_response == '':
-                continue
-            print("started to send the first chunk")
-            # await asyncio.sleep(0.1)
-            current_content = full_response
-            full_response = ""  # Clear out full_response since we've processed its content
-            if temp_message:
-                await temp_message.delete()
-            try:
-                if current_content != '':
-                    temp_message = await message.channel.send(current_content)
-                    
-                else:
-                    temp_message = await message.channel.send(".")
-                    
-            except discord.errors.HTTPException:
-                embed = create_embed(current_content)
-                embed_message = await message.channel.send(embed=embed)
-            is_first_chunk = False
-            i += 1
-            continue  # Skip to the next iteration to check for more content
-        
-        if i == 1:
-            min_chunk = 20
-        else:
-            min_chunk = 75
-        
-        # Process other chunks when size >= 50
-        while len(full_response) >= min_chunk:
-            current_content = full_response[:max_chunk_size]
-            full_response = full_response[max_chunk_size:]
-            i += 1
-            try:
-                if embed_message:
-                    embed_message = await embed_message.channel.fetch_message(embed_message.id)
-                    embed = embed_message.embeds[0]
-                    embed.description += current_content
-                    await embed_message.edit(embed=embed)
-                else:
-                    temp_message = await temp_message.channel.fetch_message(temp_message.id)
-                    await temp_message.edit(final_response)
-            except discord.errors.HTTPException as e:
-                print(e)
-                if temp_message:
-                    await temp_message.delete()  # <-- Delete temp_message if it exists
-                if not embed_message:
-                    embed = create_embed(temp_message.content + current_content)
-                    embed_message = await message.channel.send(embed=embed)
-                else:
-                    embed_message = await embed_message.channel.fetch_message(embed_message.id)
-                    embed = embed_message.embeds[0]
-                    embed.description += current_content
-                    await embed_message.edit(embed=embed)
-            await asyncio.sleep(delay)
-
-    # Processing the last remaining content (if any) in full_response
-    if full_response:
-        if embed_message:
-            embed_message = await embed_message.channel.fetch_message(embed_message.id)
-            embed = embed_message.embeds[0]
-            embed.description += full_response
-            await embed_message.edit(embed=embed)
-        else:
-            try:
-                temp_message = await temp_message.channel.fetch_message(temp_message.id)
-                await temp_message.edit(content=temp_message.content + full_response)
-            except discord.errors.HTTPException:
-                embed = create_embed(full_response)
-                await message.channel.send(embed=embed)
-
-    print("Finished with send_to_discord.")
-    return final_response, temp_message
-
-
-# Convert the lambda to a regular function
-def synchronous_generate_response(model, latest_conversation, client):
-    return client.chat.completions.create(
-        model=model,
-        messages=latest_conversation,
-        stream=True,
-        allow_fallback=True
-    )
-
-async def generate_response(conversation, message, conversation_id, client):
-    loop = asyncio.get_running_loop()
-
-    # Run the synchronous call inside a thread
-    with concurrent.futures.ThreadPoolExecutor() as pool:
-        api_call = lambda model, latest_conversation: loop.run_in_executor(pool, synchronous_generate_response, model, latest_conversation, client)
-        
-        response = await exponential_backoff(
-            api_call,
-            conversation_id=conversation_id,
-            message=message
-        )
-
-    return response
-
-async def update_conversation_and_send_to_discord(function_response, function_name, temp_message, conversation, conversation_id, message, client):
-    conversation.append(
-        {
-            "role": "function",
-            "name": function_name,
-            "content": function_response,
-        }
-    )
-    store_conversation(conversation_id, conversation)
-
-    final_response = ""
+import time
+from utils.llm_client import chain, generate_response
+from utils.render_scheduler import RenderScheduler
+from utils.store_conversation import append_message, append_messages
+from utils.turn_scheduler import turn_scheduler
+
+# A reply streams into Discord through a chain of async generators, each pulling from the last:
+#   stream_tokens -> accumulate -> split_pages -> render
+# Tokens are read straight off the HTTP stream as the renderer asks for more.
+
+MAX_MESSAGE_LENGTH = 2000
+FENCE = "```"
+
+class StreamTimings:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_token = None
+        self.first_edit = None
+        self.edits = 0
+
+    def report(self, completion):
+        def ms(moment):
+            return f"{(moment - self.started) * 1000:.0f} ms" if moment else "never"
+        print(f"(debug) Time to first token {ms(self.first_token)}, to first visible edit {ms(self.first_edit)}, "
+              f"{len(completion)} characters in {self.edits} edits over {ms(time.monotonic())}")
+
+async def stream_tokens(response, timings, first_chunk=None, tool_calls=None):
+    """The text of each streamed chunk. Tool call deltas go to the tool_calls accumulator, if given.
+    A stream that breaks off part way ends the reply early."""
     try:
-        response = await generate_response(conversation, message, conversation_id, client)
+        chunks = [first_chunk] if first_chunk is not None else []
+        async for chunk in chain(chunks, response):
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.tool_calls and tool_calls is not None:
+                tool_calls.add(delta.tool_calls)
+            content = delta.content
+            if content:
+                if timings.first_token is None:
+                    timings.first_token = time.monotonic()
+                yield content
+        print("Response generated!")
     except Exception as e:
-        print(f"Error occurred: {e}")
-        temp_message.delete()
-        return
-
-    thread_safe_queue = thread_queue.Queue()
-    threading.Thread(target=threaded_fetch, args=(response, thread_safe_queue, "")).start()
+        print(f"Response stream failed: {e}")
+
+async def accumulate(tokens, min_chunk_size):
+    """Batch tokens into chunks: the first straight away, then at least min_chunk_size characters."""
+    buffer = ""
+    first = True
+    async for token in tokens:
+        buffer += token
+        if first or len(buffer) >= min_chunk_size:
+            yield buffer
+            buffer = ""
+            first = False
+    if buffer:
+        yield buffer
+
+def open_fence(text):
+    """The opening line (e.g. "```python") of a code block left open at the end of text, or None."""
+    if text.count(FENCE) % 2 == 0:
+        return None
+    start = text.rindex(FENCE)
+    end = text.find("\n", start)
+    return text[start:end] if end != -1 else FENCE
+
+def split_point(text, limit):
+    """Where to cut text to fit in limit characters, preferring paragraph, line and word breaks."""
+    window = text[:limit]
+    for separator in ("\n\n", "\n", " "):
+        index = window.rfind(separator)
+        if index > limit // 2:
+            return index + len(separator)
+    return limit
+
+def close_fence(page):
+    return page + "\n" + FENCE if open_fence(page) is not None else page
+
+async def split_pages(chunks, max_length=MAX_MESSAGE_LENGTH):
+    """The reply so far as a list of Discord-sized pages. Pages only break between code blocks;
+    one cut inside a block is closed on its page and reopened on the next."""
+    pages = []
+    tail = ""
+    async for chunk in chunks:
+        tail += chunk
+        # Leave room for a closing fence
+        while len(tail) > max_length - len(FENCE) - 1:
+            cut = split_point(tail, max_length - len(FENCE) - 1)
+            page, tail = tail[:cut], tail[cut:]
+            fence = open_fence(page)
+            if fence is not None:
+                page = close_fence(page)
+                tail = fence + "\n" + tail
+            pages.append(page)
+        yield pages + [close_fence(tail)] if tail.strip() else list(pages)
+
+async def render(pages, temp_message, channel, timings):
+    """Show the pages as they change: the first in temp_message, the rest as new messages.
+    Edits are paced by a RenderScheduler, so pages are pulled as fast as they come."""
+    scheduler = RenderScheduler(channel, temp_message, timings)
+    try:
+        async for snapshot in pages:
+            scheduler.update(snapshot)
+    finally:
+        messages = await scheduler.close()
+    return messages
+
+async def send_to_discord(response, temp_message, message, min_chunk_size=75, timings=None, first_chunk=None, tool_calls=None):
+    """Stream a reply into Discord. Returns the full text and the last message it was shown in."""
+    timings = timings or StreamTimings()
+    parts = []
+
+    async def record(tokens):
+        async for token in tokens:
+            parts.append(token)
+            yield token
+
+    tokens = record(stream_tokens(response, timings, first_chunk, tool_calls))
+    pages = split_pages(accumulate(tokens, min_chunk_size))
+    messages = await render(pages, temp_message, message.channel, timings)
+
+    completion = "".join(parts)
+    timings.report(completion)
+    return completion, messages[-1]
+
+async def update_conversation_and_send_to_discord(function_messages, temp_message, conversation, conversation_id, message):
+    """Add the tool results to the conversation and stream the model's one follow-up reply."""
+    await append_messages(conversation_id, conversation, function_messages)
+
+    async with turn_scheduler.turn(message):
+        timings = StreamTimings()
+        try:
+            response = await generate_response(conversation_id, message, allow_fallback=True)
+        except Exception as e:
+            print(f"Error occurred: {e}")
+            await temp_message.delete()
+            return
 
-    completion, temp_message = await send_to_discord(thread_safe_queue, 75, 2000, 0.3, temp_message, final_response, message)
+        completion, temp_message = await send_to_discord(response, temp_message, message, timings=timings)
 
-    conversation.append(
+    await append_message(
+        conversation_id,
+        conversation,
         {
             "role": "assistant",
             "content": completion,
         }
     )
-    store_conversation(conversation_id, conversation)
 
     # try:
     #     await temp_message.edit(content=completion)
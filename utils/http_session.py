@@ -0,0 +1,17 @@
+"""
+One aiohttp session shared by the clients for outside APIs, so connections are kept alive and
+reused instead of opened for every call. It is created on first use, inside the event loop.
+"""
+import aiohttp
+
+MAX_CONNECTIONS = 100
+MAX_CONNECTIONS_PER_HOST = 20
+
+session = None
+
+def http_session():
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS_PER_HOST, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(connector=connector)
+    return session
@@ -0,0 +1,194 @@
+"""
+The one OpenAI chat client for the bot.
+
+Every chat completion goes through create_chat_completion on a single AsyncOpenAI client, whose
+connection pool is shared by all conversations. Streams are read directly on the event loop;
+no threads are involved.
+
+Replies are hedged across the model tiers in LLM_MODELS (primary first). If the first token
+hasn't arrived by the primary's recent p95 time to first token, the next tier is asked too;
+whichever starts streaming first is used and the other request is cancelled.
+"""
+import asyncio
+import collections
+import os
+import time
+import openai
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+from utils.exponential_backoff import exponential_backoff
+from utils.rate_limiter import admission
+
+load_dotenv()
+api_key = os.getenv("OPENAI_API_KEY")
+api_base = os.getenv("OPENAI_API_BASE")
+
+client = AsyncOpenAI(base_url=api_base, api_key=api_key, max_retries=0)
+
+REQUEST_TIMEOUT = 10  # Until the response starts, not counting time queued for the rate limit
+FIRST_TOKEN_TIMEOUT = 10  # For all hedged requests together
+MODEL_TIERS = [model.strip() for model in os.getenv("LLM_MODELS", "gpt-4-1106-preview,gpt-4-1106-preview").split(",") if model.strip()]
+HEDGE_PERCENTILE = 0.95
+HEDGE_DEFAULT_DELAY = int(os.getenv("LLM_HEDGE_DEFAULT_MS", "4000")) / 1000  # Until there are enough samples
+HEDGE_MIN_DELAY = 0.5
+HEDGE_MIN_SAMPLES = 20
+
+class FirstTokenLatency:
+    """Recent times to first token per model, and the hedging delay derived from them.
+
+    Requests that were cancelled before their first token count with the time they had waited."""
+
+    def __init__(self, window=200):
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.hedges = 0
+        self.fallback_wins = 0
+
+    def record(self, model, seconds):
+        self.samples[model].append(seconds)
+
+    def hedge_delay(self, model):
+        samples = sorted(self.samples[model])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(samples[int(HEDGE_PERCENTILE * (len(samples) - 1))], HEDGE_MIN_DELAY)
+
+    def stats(self):
+        delays = ", ".join(f"{model} hedges after {self.hedge_delay(model):.2f}s" for model in self.samples)
+        return f"{self.hedges} hedged requests, {self.fallback_wins} answered by a fallback model; {delays}"
+
+first_token_latency = FirstTokenLatency()
+
+async def create_chat_completion(model, messages, stream=True, tools=None, allow_fallback=False, on_admitted=None):
+    """Wait for the model's rate limit budget, then send the request. on_admitted is called just before it's sent."""
+    kwargs = {}
+    if tools:
+        kwargs["tools"] = tools
+    if allow_fallback:
+        # Understood by our API proxy, not part of the OpenAI API
+        kwargs["extra_body"] = {"allow_fallback": True}
+
+    await admission.acquire(model, messages)
+    if on_admitted is not None:
+        on_admitted()
+    try:
+        raw = await asyncio.wait_for(
+            client.chat.completions.with_raw_response.create(model=model, messages=messages, stream=stream, **kwargs),
+            timeout=REQUEST_TIMEOUT,
+        )
+    except openai.RateLimitError as e:
+        admission.throttled(model, e.response.headers)
+        raise
+    admission.update(model, raw.headers)
+    return raw.parse()
+
+async def chain(chunks, response):
+    for chunk in chunks:
+        yield chunk
+    async for chunk in response:
+        yield chunk
+
+async def first_token(model, messages, on_admitted=None, **kwargs):
+    """Start a stream and read up to its first token. Returns the stream with those chunks put back."""
+    started = None
+
+    def admitted():
+        # Time queued for the rate limit isn't part of the model's latency
+        nonlocal started
+        started = time.monotonic()
+        if on_admitted is not None:
+            on_admitted()
+
+    stream = None
+    chunks = []
+    try:
+        stream = await create_chat_completion(model, messages, on_admitted=admitted, **kwargs)
+        while True:
+            chunk = await stream.__anext__()
+            chunks.append(chunk)
+            if chunk.choices and (chunk.choices[0].delta.content or chunk.choices[0].delta.tool_calls):
+                break
+    except StopAsyncIteration:
+        pass
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError) and started is not None:
+            # It lost the race or ran out of time, so its first token would have taken at least
+            # this long. Leaving it out would pull the hedging delay down to the winners' times
+            first_token_latency.record(model, time.monotonic() - started)
+        if stream is not None:
+            await stream.close()
+        raise
+    first_token_latency.record(model, time.monotonic() - started)
+    return stream, chain(chunks, stream)
+
+async def hedged_completion(models, messages, **kwargs):
+    """Stream from the first of models to produce a token, asking the next one each time the
+    latest request goes past its hedging delay or fails. The hedging delays and the overall
+    timeout only count from when a request gets through the rate limiter and is sent."""
+    loop = asyncio.get_running_loop()
+    attempts = {}
+    sent_at = {}  # Attempt -> when its request was sent
+    sent = asyncio.Event()
+    errors = []
+    remaining = list(models)
+
+    def launch():
+        model = remaining.pop(0)
+
+        def admitted():
+            sent_at[task] = loop.time()
+            sent.set()
+
+        task = asyncio.create_task(first_token(model, messages, on_admitted=admitted, **kwargs))
+        attempts[task] = model
+        return task
+
+    latest = launch()
+    waiter = None
+    try:
+        while attempts:
+            deadline = min(sent_at.values()) + FIRST_TOKEN_TIMEOUT if sent_at else None
+            hedge_at = sent_at[latest] + first_token_latency.hedge_delay(attempts[latest]) if latest in sent_at else None
+            wake_at = min((t for t in (deadline, hedge_at if remaining else None) if t is not None), default=None)
+            sent.clear()
+            waiter = asyncio.create_task(sent.wait())
+            done, _ = await asyncio.wait(
+                [*attempts, waiter],
+                timeout=None if wake_at is None else max(wake_at - loop.time(), 0),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            waiter.cancel()
+            for task in done:
+                if task is waiter:
+                    continue
+                model = attempts.pop(task)
+                if task.exception() is None:
+                    if model != models[0]:
+                        first_token_latency.fallback_wins += 1
+                        print(f"(debug) {model} answered first.")
+                    return task.result()[1]
+                errors.append(task.exception())
+            if deadline is not None and loop.time() >= deadline:
+                raise asyncio.TimeoutError()
+            if remaining and (latest not in attempts or (hedge_at is not None and loop.time() >= hedge_at)):
+                if attempts:
+                    first_token_latency.hedges += 1
+                    print(f"\033[33mNo first token from {list(attempts.values())} yet, also trying {remaining[0]}.\033[0m")
+                latest = launch()
+        raise errors[-1]
+    finally:
+        if waiter is not None:
+            waiter.cancel()
+        for task in attempts:
+            task.cancel()
+            task.add_done_callback(close_unused_stream)
+
+def close_unused_stream(task):
+    if not task.cancelled() and task.exception() is None:
+        asyncio.create_task(task.result()[0].close())
+
+async def generate_response(conversation_id, message, tools=None, allow_fallback=False):
+    """Stream a reply to the stored conversation, retrying and hedging across model tiers as needed."""
+    api_call = lambda models, latest_conversation: hedged_completion(
+        models, latest_conversation, tools=tools, allow_fallback=allow_fallback
+    )
+    return await exponential_backoff(api_call, conversation_id=conversation_id, message=message, models=MODEL_TIERS)
@@ -1,31 +1,24 @@
-import openai
-from dotenv import load_dotenv
-import os
 from datetime import datetime
 import pytz
-from utils.get_and_set_timezone import get_timezone, set_timezone
+from utils.get_and_set_timezone import get_tzinfo
+from utils.moderation_service import moderation_service
 
-def moderate_content(message):
+async def moderate_content(message):
     """
     Moderates the content of the message and adjusts it according to the user's timezone.
     """
 
-    # Load OpenAI API settings
-    load_dotenv()
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-
-    # Fetch moderation results from OpenAI
-    response = openai.Moderation.create(input=message.content)
-    moderation_result = response["results"][0]
+    # Fetch moderation results from OpenAI, batched with other messages arriving at the same time
+    verdict = await moderation_service.moderate(message.content)
 
     # Fetch Discord ID and timezone
     discord_id = message.author.id
-    user_timezone = get_timezone(discord_id)
+    user_timezone = get_tzinfo(discord_id)
 
     # Get current time in UTC and localize it to the user's timezone
     timestamp = datetime.utcnow()
     utc_time = pytz.utc.localize(timestamp)
-    local_time = utc_time.astimezone(pytz.timezone(user_timezone))
+    local_time = utc_time.astimezone(user_timezone)
 
     # Get the abbreviation of the current timezone (like BST, GMT, etc.)
     tz_abbr = local_time.tzname()
@@ -33,9 +26,8 @@ def moderate_content(message):
     # Format the time
     formatted_time = local_time.strftime("%Y-%m-%d %H:%M")
 
-    if moderation_result["flagged"]:
-        reasons = [category for category, flagged in moderation_result["categories"].items() if flagged]
-        reason_string = ', '.join(reasons)
+    if verdict.flagged:
+        reason_string = ', '.join(verdict.categories)
         print(f"Message flagged for: {reason_string} \nOriginal message: {message.content} by {message.author.display_name}")
         return f"{message.author.display_name} said: [content flagged for {reason_string}]"
     else:
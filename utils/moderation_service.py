@@ -0,0 +1,129 @@
+"""
+Micro-batched OpenAI moderation.
+
+Messages that arrive within MODERATION_BATCH_WINDOW_MS of each other go out as one multi-input
+moderation request, and each caller gets back the verdict for its own text. The queue is bounded
+(MODERATION_MAX_QUEUE), and a caller gives up after MODERATION_MAX_LATENCY_MS, including time
+spent waiting for room in the queue.
+
+Verdicts are cached for MODERATION_CACHE_TTL seconds, keyed by a hash of the normalized text,
+so repeated messages ("lol", "ok", copypasta) are only sent once.
+"""
+import asyncio
+import hashlib
+import os
+import time
+import cachetools
+from dotenv import load_dotenv
+from utils.llm_client import client
+
+load_dotenv()
+BATCH_WINDOW = int(os.getenv("MODERATION_BATCH_WINDOW_MS", "50")) / 1000
+MAX_LATENCY = int(os.getenv("MODERATION_MAX_LATENCY_MS", "5000")) / 1000
+MAX_BATCH_SIZE = int(os.getenv("MODERATION_MAX_BATCH_SIZE", "32"))
+MAX_QUEUE = int(os.getenv("MODERATION_MAX_QUEUE", "256"))
+CACHE_SIZE = int(os.getenv("MODERATION_CACHE_SIZE", "20000"))
+CACHE_TTL = int(os.getenv("MODERATION_CACHE_TTL", "3600"))
+
+def normalized_key(text):
+    """Texts differing only in case or whitespace share a verdict."""
+    normalized = " ".join(text.casefold().split())
+    return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+
+class ModerationVerdict:
+    def __init__(self, flagged, categories):
+        self.flagged = flagged
+        self.categories = categories  # Names of the flagged categories, e.g. "self-harm"
+
+    @classmethod
+    def from_result(cls, result):
+        categories = result.categories.model_dump(by_alias=True)
+        return cls(result.flagged, [category for category, flagged in categories.items() if flagged])
+
+class ModerationService:
+    def __init__(self, client, batch_window=BATCH_WINDOW, max_latency=MAX_LATENCY, max_batch_size=MAX_BATCH_SIZE, max_queue=MAX_QUEUE, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL):
+        self.client = client
+        self.batch_window = batch_window
+        self.max_latency = max_latency
+        self.max_batch_size = max_batch_size
+        self.max_queue = max_queue
+        self.queue = None
+        self.worker = None
+        self.requests_in_flight = set()
+        self.verdicts = cachetools.TTLCache(cache_size, cache_ttl)
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.inputs = 0
+
+    def start(self):
+        # The queue and worker belong to the running event loop, so they're created on first use
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue(self.max_queue)
+            self.worker = asyncio.create_task(self.run())
+
+    async def moderate(self, text):
+        """The verdict for one piece of text. Raises asyncio.TimeoutError past the latency cap."""
+        key = normalized_key(text)
+        verdict = self.verdicts.get(key)
+        if verdict is not None:
+            self.hits += 1
+            return verdict
+        self.misses += 1
+
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        verdict = await asyncio.wait_for(self.enqueue(text, future), self.max_latency)
+        self.verdicts[key] = verdict
+        return verdict
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return (f"{self.hits} cache hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{self.inputs} texts sent in {self.requests} requests")
+
+    async def enqueue(self, text, future):
+        await self.queue.put((text, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Callers that already timed out don't need a verdict
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if batch:
+                # Send in the background so the next batch can fill up while this one is in flight
+                request = asyncio.create_task(self.send(batch))
+                self.requests_in_flight.add(request)
+                request.add_done_callback(self.requests_in_flight.discard)
+
+    async def send(self, batch):
+        self.requests += 1
+        self.inputs += len(batch)
+        try:
+            response = await self.client.moderations.create(input=[text for text, _ in batch])
+            verdicts = [ModerationVerdict.from_result(result) for result in response.results]
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), verdict in zip(batch, verdicts):
+            if not future.done():
+                future.set_result(verdict)
+        for _, future in batch[len(verdicts):]:
+            if not future.done():
+                future.set_exception(RuntimeError("Moderation response is missing results"))
+
+# Same client as the chat completions, so moderation uses the same endpoint and connection pool
+moderation_service = ModerationService(client)
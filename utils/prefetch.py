@@ -0,0 +1,71 @@
+"""
+Starts scraping links as soon as someone posts them to the bot.
+
+By the time the model decides to call scrape_web_page the page is usually already in the
+scrape cache, or at least on its way: the tool call joins the prefetch (see single_flight.py)
+instead of starting its own. At most MAX_PREFETCHES_PER_CHANNEL pages are prefetched at once per channel.
+"""
+import asyncio
+import os
+import re
+import cachetools
+from dotenv import load_dotenv
+from utils.scrape_web_page import fetch_page, normalize_url, scrape_web_page
+
+load_dotenv()
+MAX_PREFETCHES_PER_CHANNEL = int(os.getenv("PREFETCH_MAX_PER_CHANNEL", "2"))
+URL_PATTERN = re.compile(r"https?://[^\s<>\"']+")
+
+def find_urls(text):
+    # Drop punctuation that ends the sentence rather than the link
+    return list(dict.fromkeys(url.rstrip(".,;:!?)]}") for url in URL_PATTERN.findall(text)))
+
+class Prefetcher:
+    def __init__(self, max_per_channel=MAX_PREFETCHES_PER_CHANNEL):
+        self.max_per_channel = max_per_channel
+        # Keyed by normalize_url(url), like the scrape cache, so any spelling of a page counts
+        self.in_flight = {}  # key -> task
+        self.channel_in_flight = {}
+        # key -> whether a tool call has asked for it yet
+        self.prefetched = cachetools.TTLCache(maxsize=1000, ttl=3600)
+        self.started = 0
+        self.hits = 0
+        self.skipped = 0
+
+    def prefetch(self, channel_id, text):
+        for url in find_urls(text):
+            key = normalize_url(url)
+            if key in self.in_flight:
+                continue
+            if self.channel_in_flight.get(channel_id, 0) >= self.max_per_channel:
+                self.skipped += 1
+                continue
+            print(f"(debug) Prefetching {url}")
+            self.channel_in_flight[channel_id] = self.channel_in_flight.get(channel_id, 0) + 1
+            self.started += 1
+            self.prefetched[key] = False
+            task = asyncio.create_task(fetch_page(url))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _, key=key: self.finished(channel_id, key))
+
+    def finished(self, channel_id, key):
+        del self.in_flight[key]
+        self.channel_in_flight[channel_id] -= 1
+        if not self.channel_in_flight[channel_id]:
+            del self.channel_in_flight[channel_id]
+
+    async def scrape(self, url, query=None):
+        """scrape_web_page, counting whether the page was prefetched."""
+        key = normalize_url(url)
+        if self.prefetched.get(key) is False:
+            self.prefetched[key] = True
+            self.hits += 1
+        return await scrape_web_page(url, query)
+
+    def stats(self):
+        hit_rate = self.hits / self.started if self.started else 0
+        return (f"{self.started} pages prefetched, {self.hits} used ({hit_rate:.0%}), "
+                f"{self.started - self.hits} unused ({1 - hit_rate if self.started else 0:.0%}), "
+                f"{self.skipped} skipped by the per-channel cap")
+
+prefetcher = Prefetcher()
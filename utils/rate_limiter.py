@@ -0,0 +1,153 @@
+"""
+Admission control for chat completions, shared by every conversation.
+
+OpenAI reports each model's remaining requests-per-minute and tokens-per-minute budgets, and
+when they reset, in the x-ratelimit-* response headers. Before a request is sent its token
+cost is estimated from the conversation, and it waits in a FIFO queue until the budget it
+would use is available. A 429 empties the model's budget until the reset time the API gives
+back. Waiting requests only ever sleep on the event loop.
+"""
+import asyncio
+import os
+import re
+import time
+from dotenv import load_dotenv
+from utils.count_tokens_in_conversation import count_tokens_in_conversation
+
+load_dotenv()
+# Completion tokens count against the TPM budget too, so each request reserves this many on top of its prompt
+EXPECTED_COMPLETION_TOKENS = int(os.getenv("EXPECTED_COMPLETION_TOKENS", "1000"))
+MAX_WAIT_STEP = 1.0
+WINDOW = 60.0
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_duration(value):
+    """Seconds in a reset header such as "20ms", "1s" or "6m0s"."""
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in DURATION_PART.findall(value or ""))
+
+def estimate_cost(messages):
+    return count_tokens_in_conversation(messages) + EXPECTED_COMPLETION_TOKENS
+
+class Budget:
+    """What's left of one limit (requests or tokens) until it resets."""
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None  # Unknown until the first response
+        self.reset_at = 0.0
+
+    def available(self, now):
+        if self.remaining is None:
+            return float("inf")
+        if now >= self.reset_at:
+            return self.limit if self.limit is not None else float("inf")
+        return self.remaining
+
+    def spend(self, amount, now):
+        if self.remaining is None:
+            return
+        if now >= self.reset_at:
+            # The budget has refilled since the last response; assume a fresh one-minute window
+            self.remaining = self.available(now)
+            self.reset_at = now + WINDOW
+        self.remaining -= amount
+
+    def update(self, limit, remaining, reset, now):
+        if remaining is None:
+            return
+        self.limit = int(limit) if limit else self.limit
+        self.remaining = int(remaining)
+        self.reset_at = now + parse_duration(reset)
+
+    def exhaust(self, retry_after, now):
+        self.remaining = 0
+        self.reset_at = now + retry_after
+
+class ModelLimits:
+    def __init__(self):
+        self.requests = Budget()
+        self.tokens = Budget()
+        self.queue = asyncio.Lock()  # Fair: waiters get the budget in arrival order
+        self.updated = asyncio.Event()
+        self.waiting = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    async def acquire(self, cost):
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            async with self.queue:
+                while True:
+                    now = time.monotonic()
+                    # A request bigger than a whole minute's budget goes as soon as the budget is full
+                    token_limit = self.tokens.limit or cost
+                    if self.requests.available(now) >= 1 and self.tokens.available(now) >= min(cost, token_limit):
+                        self.requests.spend(1, now)
+                        self.tokens.spend(cost, now)
+                        break
+                    resets = [b.reset_at for b in (self.requests, self.tokens) if b.reset_at > now]
+                    wait = min(min(resets, default=now + MAX_WAIT_STEP) - now, MAX_WAIT_STEP)
+                    self.updated.clear()
+                    try:
+                        await asyncio.wait_for(self.updated.wait(), max(wait, 0.01))
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        if waited > 0.01:
+            self.waits += 1
+            self.wait_time += waited
+
+    def update(self, headers):
+        now = time.monotonic()
+        self.requests.update(headers.get("x-ratelimit-limit-requests"), headers.get("x-ratelimit-remaining-requests"),
+                             headers.get("x-ratelimit-reset-requests"), now)
+        self.tokens.update(headers.get("x-ratelimit-limit-tokens"), headers.get("x-ratelimit-remaining-tokens"),
+                           headers.get("x-ratelimit-reset-tokens"), now)
+        self.updated.set()
+
+    def throttled(self, headers):
+        """Hold every request back until the API says to retry."""
+        self.update(headers)
+        self.requests.exhaust(retry_after(headers), time.monotonic())
+        self.updated.set()
+
+def retry_after(headers):
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return 1.0
+
+class AdmissionController:
+    def __init__(self):
+        self.models = {}
+
+    def limits(self, model):
+        if model not in self.models:
+            self.models[model] = ModelLimits()
+        return self.models[model]
+
+    async def acquire(self, model, messages):
+        await self.limits(model).acquire(estimate_cost(messages))
+
+    def update(self, model, headers):
+        self.limits(model).update(headers)
+
+    def throttled(self, model, headers):
+        self.limits(model).throttled(headers)
+
+    def stats(self):
+        return ", ".join(
+            f"{model}: {limits.waiting} waiting, {limits.waits} waited {limits.wait_time:.1f}s in total"
+            for model, limits in self.models.items()
+        )
+
+admission = AdmissionController()
@@ -0,0 +1,137 @@
+"""
+Paces the message edits that show a streaming reply.
+
+The reply's latest text is kept in memory, and a single task per reply writes it to Discord
+as fast as the channel's rate limit allows. Updates that arrive while an edit is in flight
+are coalesced, so only the newest text is ever sent.
+
+Pycord doesn't expose how much of a rate limit bucket is left, so each channel's budget is
+mirrored locally: a token bucket sized like Discord's per-channel message limit, plus an
+AIMD interval between edits. A 429, or an edit that pycord had to hold back for its own
+rate limit handling, halves the pace; every quick edit speeds it back up a little.
+"""
+import asyncio
+import time
+import cachetools
+import discord
+
+EDITS_PER_WINDOW = 5
+WINDOW = 5.0
+MIN_INTERVAL = 0.25
+MAX_INTERVAL = 5.0
+INTERVAL_STEP = 0.05
+SLOW_EDIT = 1.5  # Edits slower than this were most likely held back by a rate limit
+
+class EditBudget:
+    def __init__(self, capacity=EDITS_PER_WINDOW, window=WINDOW):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.interval = MIN_INTERVAL
+        self.last_edit = 0.0
+        self.throttles = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self.refill()
+            wait = max((1 - self.tokens) / self.rate, self.last_edit + self.interval - time.monotonic())
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self.tokens -= 1
+        self.last_edit = time.monotonic()
+
+    def throttled(self):
+        self.throttles += 1
+        self.tokens = 0
+        self.interval = min(self.interval * 2, MAX_INTERVAL)
+
+    def succeeded(self):
+        self.interval = max(self.interval - INTERVAL_STEP, MIN_INTERVAL)
+
+# Shared by every reply in a channel, since Discord's buckets are per channel
+channel_budgets = cachetools.LRUCache(1000)
+
+def channel_budget(channel_id):
+    budget = channel_budgets.get(channel_id)
+    if budget is None:
+        budget = channel_budgets[channel_id] = EditBudget()
+    return budget
+
+class RenderScheduler:
+    def __init__(self, channel, first_message, timings):
+        self.channel = channel
+        self.messages = [first_message]
+        self.shown = [first_message.content]
+        self.pending = [first_message.content]
+        self.timings = timings
+        self.budget = channel_budget(channel.id)
+        self.changed = asyncio.Event()
+        self.closed = False
+        self.task = asyncio.create_task(self.run())
+
+    def update(self, pages):
+        """Replace the text to show. Never waits; older pending text is simply dropped."""
+        if self.task.done():
+            return
+        self.pending = list(pages)
+        self.changed.set()
+
+    async def close(self):
+        """Wait for the latest text to be shown, then return every message used."""
+        self.closed = True
+        self.changed.set()
+        await self.task
+        return self.messages
+
+    def next_page(self):
+        for i, page in enumerate(self.pending):
+            if i >= len(self.shown) or self.shown[i] != page:
+                return i
+        return None
+
+    async def run(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            while (i := self.next_page()) is not None:
+                await self.budget.acquire()
+                await self.show(i, self.pending[i])
+            if self.closed:
+                return
+
+    async def show(self, i, page):
+        started = time.monotonic()
+        try:
+            if i < len(self.messages):
+                await self.messages[i].edit(content=page)
+            else:
+                self.messages.append(await self.channel.send(page))
+        except Exception as e:
+            if isinstance(e, discord.errors.HTTPException) and e.status == 429:
+                self.budget.throttled()
+                return
+            print(f"Failed to show reply: {e}")
+            if i >= len(self.messages):
+                # Without the message for this page there's nowhere to put the rest of the reply
+                self.pending = self.pending[:i]
+                self.closed = True
+                return
+        else:
+            if time.monotonic() - started > SLOW_EDIT:
+                self.budget.throttled()
+            else:
+                self.budget.succeeded()
+            self.timings.edits += 1
+            if self.timings.first_edit is None:
+                self.timings.first_edit = time.monotonic()
+        if i < len(self.shown):
+            self.shown[i] = page
+        else:
+            self.shown.append(page)
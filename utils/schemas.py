@@ -0,0 +1,107 @@
+"""
+The schemas of the bot's SQLite databases, as lists of migrations.
+
+Each migration is a function of a connection. They're applied in order and tracked with
+PRAGMA user_version, so a database only runs the ones it hasn't had yet. Nothing here opens a
+database: utils/storage.py applies them on startup, and offline tools such as
+`python -m utils.compression migrate` apply them to the connection they're given.
+"""
+import json
+from utils.compression import ZLIB_SEED_DICTIONARY, encode_message
+
+def apply_migrations(conn, migrations):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(migrations[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {number}")
+        print(f"(debug) Migrated database to schema version {number}.")
+
+def schema(migrations):
+    """An AsyncDatabase init function that migrates the database to the given schema."""
+    return lambda conn: apply_migrations(conn, migrations)
+
+# --- conversations.db ---
+
+def conversations_v1(conn):
+    # One row per message, ordered by ordinal. Appending a message is a single INSERT
+    # and trimming is a single range DELETE instead of rewriting the whole conversation.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS messages
+        (conversation_id INTEGER NOT NULL,
+        ordinal INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        message TEXT NOT NULL,
+        PRIMARY KEY (conversation_id, ordinal))
+        WITHOUT ROWID
+    """)
+
+    # Move conversations from the old one-blob-per-channel table into message rows
+    legacy = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='conversations'").fetchone()
+    if legacy is None:
+        return
+    for conversation_id, conversation in conn.execute("SELECT conversation_id, conversation FROM conversations").fetchall():
+        if not conversation:
+            continue
+        conn.executemany(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+            [(conversation_id, ordinal, m["role"], encode_message(m, "none")) for ordinal, m in enumerate(json.loads(conversation))],
+        )
+    conn.execute("DROP TABLE conversations")
+
+def conversations_v2(conn):
+    # Shared dictionaries for compressed messages (see utils/compression.py). Rows are never
+    # changed or deleted, since every message compressed with one needs it to be read back.
+    conn.execute("""
+    CREATE TABLE compression_dictionaries
+        (id INTEGER PRIMARY KEY,
+        codec TEXT NOT NULL,
+        dictionary BLOB NOT NULL)
+    """)
+    conn.execute("INSERT INTO compression_dictionaries (codec, dictionary) VALUES ('zlib', ?)", (ZLIB_SEED_DICTIONARY,))
+
+CONVERSATIONS_SCHEMA = (conversations_v1, conversations_v2)
+
+# --- discord_timezones.db ---
+
+def timezones_v1(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS UserTimezones (
+        discord_id INTEGER PRIMARY KEY,
+        timezone TEXT
+    );
+    """)
+
+TIMEZONES_SCHEMA = (timezones_v1,)
+
+# --- conversation_times.db ---
+
+def conversation_times_v1(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_times (
+            conversation_id TEXT PRIMARY KEY,
+            last_message_time DATETIME,
+            next_message_time DATETIME
+        )
+    """)
+
+CONVERSATION_TIMES_SCHEMA = (conversation_times_v1,)
+
+# --- scrape_cache.db ---
+
+def scrape_cache_v1(conn):
+    # One row per normalized URL. size is len(text), kept so eviction doesn't have to read the pages.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS scraped_pages (
+            url TEXT PRIMARY KEY,
+            text TEXT NOT NULL,
+            content_type TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            size INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS scraped_pages_last_used ON scraped_pages (last_used)")
+
+SCRAPE_CACHE_SCHEMA = (scrape_cache_v1,)
@@ -1,40 +1,118 @@
-import requests
-import json
-import cachetools
+import asyncio
+import os
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import aiohttp
+from dotenv import load_dotenv
+from utils.extract_passages import relevant_passages
+from utils.http_session import http_session
+from utils.scraper_client import SCRAPER_TIMEOUT, scraper
+from utils.single_flight import single_flight
+from utils.storage import load_scraped_page, mark_scraped_page_revalidated, mark_scraped_page_used, save_scraped_page
 
-scrape_cache = cachetools.TTLCache(maxsize=100, ttl=3600*60*24)
+load_dotenv()
+# Most of a page that's sent to the model, in tokens
+SCRAPE_TOKEN_BUDGET = int(os.getenv("SCRAPE_TOKEN_BUDGET", "500"))
+# Pages are evicted, least recently used first, once the cache holds more than this many characters
+SCRAPE_CACHE_MAX_SIZE = int(os.getenv("SCRAPE_CACHE_MAX_MB", "256")) * 1024 * 1024
+PROBE_TIMEOUT = 5
+# Longest a scrape can take: revalidating a stale cached page, then rendering it (the validators
+# are fetched meanwhile), with a few seconds for the cache. The scrape_web_page tool waits this long
+SCRAPE_TIMEOUT = PROBE_TIMEOUT + SCRAPER_TIMEOUT + 5
 
-def scrape_web_page(url):
-    if url in scrape_cache:
-        print("(debug) Using cached web page scrape.")
-        return scrape_cache[url]  # Return cached scraped data if available
+# How long a cached page is used without asking the site whether it changed, by content type
+FRESHNESS = {
+    "text/html": 6 * 3600,
+    "text/plain": 24 * 3600,
+    "application/json": 10 * 60,
+    "application/xml": 3600,
+    "application/pdf": 7 * 24 * 3600,
+}
+DEFAULT_FRESHNESS = 6 * 3600
 
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid")
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def normalize_url(url):
+    """The cache key for a URL: no fragment or tracking parameters, and the scheme and host in lower case."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ""
+    if ":" in host:
+        host = f"[{host}]"
     try:
-        # Send the URL to the Node.js server and get the scraped data
-        response = requests.post("http://localhost:3000/scrape", json={"url": url})
-        response.raise_for_status()  # Raises an HTTPError for bad status codes
-    except requests.RequestException as e:
-        error_message = f"Failed to scrape the webpage due to an HTTP error: {e}"
-        print(f"(debug) {error_message}")
-        return error_message
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host += f":{port}"
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.lower().startswith(TRACKING_PARAMS)])
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+def freshness(content_type):
+    return FRESHNESS.get(content_type, DEFAULT_FRESHNESS)
 
-    print("(debug) Scraped web page. response: ", response.status_code)
+def media_type(response):
+    return response.headers.get("Content-Type", "").split(";")[0].strip().lower() or None
 
+async def fetch_validators(url):
+    """(content_type, etag, last_modified) from the site itself, without rendering the page."""
     try:
-        scraped_data = response.json()
-    except json.JSONDecodeError:
-        error_message = "Failed to decode JSON from the webpage response."
-        print(f"(debug) {error_message}")
-        return error_message
+        async with http_session().head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as response:
+            if response.status >= 400:
+                return None, None, None
+            return media_type(response), response.headers.get("ETag"), response.headers.get("Last-Modified")
+    except Exception as e:
+        print(f"(debug) Couldn't get validators for {url}: {e}")
+        return None, None, None
 
-    # Check if an error occurred
-    if "error" in scraped_data:
-        print(f"(debug) Error occurred while scraping: {scraped_data['error']}")
-        # Create a user-friendly error message
-        error_message = f"I'm sorry, but I encountered an error while trying to read the webpage at {url}. The specific error was: {scraped_data['error']}. This might be due to the site being down or having security settings that prevent me from reading it. You might want to try again later or check the site yourself."
-        return error_message
+async def unchanged(url, etag, last_modified):
+    """Whether the site answers a conditional request for the page with 304 Not Modified."""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        async with http_session().get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as response:
+            return response.status == 304
+    except Exception as e:
+        print(f"(debug) Couldn't revalidate {url}: {e}")
+        return False
 
-    # Limit the length of the scraped text
-    scraped_text = scraped_data["data"][0:2000]
-    scrape_cache[url] = scraped_text  # Cache the scraped data before returning
-    return scraped_text
+async def fetch_page(url):
+    """The whole text of the page, from the cache if it's still good. Returns (text, None), or (None, error message)."""
+    key = normalize_url(url)
+    return await single_flight.run(("scrape_web_page", key), lambda: load_page(url, key))
+
+async def load_page(url, key):
+    now = time.time()
+    cached = await load_scraped_page(key)
+    if cached is not None:
+        text, content_type, etag, last_modified, fetched_at = cached
+        if now - fetched_at < freshness(content_type):
+            print("(debug) Using cached web page scrape.")
+            await mark_scraped_page_used(key, now)
+            return text, None
+        if (etag or last_modified) and await unchanged(url, etag, last_modified):
+            print("(debug) Cached web page scrape is still current.")
+            await mark_scraped_page_revalidated(key, now)
+            return text, None
+
+    # The validators come from the site while the scraper renders the page
+    validators = asyncio.create_task(fetch_validators(url))
+    text, error_message = await scraper.render(url)
+    if error_message is not None:
+        validators.cancel()
+        return None, error_message
+    content_type, etag, last_modified = await validators
+
+    await save_scraped_page(key, text, content_type, etag, last_modified, now, SCRAPE_CACHE_MAX_SIZE)
+    return text, None
+
+async def scrape_web_page(url, query=None, max_tokens=SCRAPE_TOKEN_BUDGET):
+    """The parts of the page most relevant to query, or an error message for the model."""
+    text, error_message = await fetch_page(url)
+    if error_message is not None:
+        return error_message
+    return relevant_passages(text, query, max_tokens)
@@ -0,0 +1,139 @@
+"""
+Client for the Puppeteer scrape service in nodejs/app.js.
+
+Requests go over the shared keep-alive session. At most SCRAPER_MAX_PAGES are rendered at once,
+to match the number of browser pages the service can keep open, and each call has to finish
+within SCRAPER_TIMEOUT seconds, waiting for a page included. When the service itself is failing
+(refused connections, timeouts, 5xx without an error message) the circuit breaker opens and calls
+fail straight away for BREAKER_COOLDOWN seconds, after which a single call is let through to
+see whether it has recovered. A page the service couldn't load doesn't count as a failure.
+"""
+import asyncio
+import json
+import os
+import time
+import aiohttp
+from dotenv import load_dotenv
+from utils.http_session import http_session
+
+load_dotenv()
+SCRAPER_URL = os.getenv("SCRAPER_URL", "http://localhost:3000/scrape")
+SCRAPER_MAX_PAGES = int(os.getenv("SCRAPER_MAX_PAGES", "4"))
+SCRAPER_TIMEOUT = float(os.getenv("SCRAPER_TIMEOUT", "35"))  # The service gives up on a page after 30
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+
+class ScraperError(Exception):
+    """The scrape service is down or misbehaving, as opposed to the page being unreadable."""
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False  # Whether the one call allowed through after the cooldown is running
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        """Whether a call may go ahead, and whether it's the trial call after the cooldown."""
+        if self.opened_at is None:
+            return True, False
+        if self.state == "half-open" and not self.trial:
+            self.trial = True
+            return True, True
+        return False, False
+
+    def succeeded(self, trial):
+        # Calls started before the circuit opened can still finish while it's open, but only the
+        # trial call decides whether the service has recovered
+        if trial or self.opened_at is None:
+            self.failures = 0
+            self.opened_at = None
+        if trial:
+            self.trial = False
+
+    def failed(self, trial):
+        self.failures += 1
+        if trial or (self.opened_at is None and self.failures >= self.threshold):
+            print(f"(debug) Scrape service failed {self.failures} times in a row; pausing scrapes for {self.cooldown:.0f}s")
+            self.opened_at = time.monotonic()
+            self.trips += 1
+        if trial:
+            self.trial = False
+
+class ScraperClient:
+    def __init__(self, url=SCRAPER_URL, max_pages=SCRAPER_MAX_PAGES, timeout=SCRAPER_TIMEOUT):
+        self.url = url
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.pages = asyncio.Semaphore(max_pages)
+        self.breaker = CircuitBreaker()
+        self.rendering = 0
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+
+    async def post(self, url):
+        async with self.pages:
+            self.rendering += 1
+            try:
+                async with http_session().post(self.url, json={"url": url}) as response:
+                    try:
+                        scraped_data = await response.json(content_type=None)
+                    except (json.JSONDecodeError, aiohttp.ContentTypeError):
+                        raise ScraperError(f"the scrape service answered {response.status} without JSON")
+                    if not isinstance(scraped_data, dict):
+                        raise ScraperError(f"the scrape service answered {response.status} without a result")
+                    if response.status >= 500 and "error" not in scraped_data:
+                        raise ScraperError(f"the scrape service answered {response.status}")
+                    return scraped_data
+            finally:
+                self.rendering -= 1
+
+    async def render(self, url):
+        """Have the service load the page. Returns (text, None), or (None, error message)."""
+        allowed, trial = self.breaker.allow()
+        if not allowed:
+            self.rejected += 1
+            return None, "I can't read web pages right now because the page reader is having trouble. Try again in a minute."
+
+        self.requests += 1
+        try:
+            scraped_data = await asyncio.wait_for(self.post(url), self.timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ScraperError) as e:
+            self.failures += 1
+            self.breaker.failed(trial)
+            reason = f"it took longer than {self.timeout:g} seconds" if isinstance(e, asyncio.TimeoutError) else str(e) or type(e).__name__
+            error_message = f"Failed to scrape the webpage because {reason}."
+            print(f"(debug) {error_message}")
+            return None, error_message
+        else:
+            self.breaker.succeeded(trial)
+        finally:
+            if trial:
+                # If the trial was cancelled, the next call gets to be the trial instead
+                self.breaker.trial = False
+
+        # Check if an error occurred
+        if "error" in scraped_data:
+            print(f"(debug) Error occurred while scraping: {scraped_data['error']}")
+            # Create a user-friendly error message
+            error_message = f"I'm sorry, but I encountered an error while trying to read the webpage at {url}. The specific error was: {scraped_data['error']}. This might be due to the site being down or having security settings that prevent me from reading it. You might want to try again later or check the site yourself."
+            return None, error_message
+
+        print(f"(debug) Scraped web page {url}")
+        return scraped_data.get("data") or "", None
+
+    def stats(self):
+        return (f"{self.rendering}/{self.max_pages} pages rendering, {self.requests} requests, "
+                f"{self.failures} failed, {self.rejected} rejected, circuit {self.breaker.state} "
+                f"(tripped {self.breaker.trips} times)")
+
+scraper = ScraperClient()
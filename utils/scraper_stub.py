@@ -0,0 +1,60 @@
+"""
+A stand-in for the Puppeteer scrape service, for trying out the scraper client without a browser.
+
+It answers POST /scrape like nodejs/app.js does, after an optional delay, and can be told to
+fail some pages (500 with an error, like a site that won't load) or to fail as a service
+(503 without a body, like a crashed browser). It also reports when more pages are requested
+at once than --max-pages. Run it in place of the real service with:
+
+    python -m utils.scraper_stub --port 3000 --delay 2 --page-error-rate 0.1
+"""
+import argparse
+import asyncio
+import random
+from aiohttp import web
+
+STATE = web.AppKey("state", dict)
+
+def make_app(delay=0.0, page_error_rate=0.0, service_error_rate=0.0, max_pages=None):
+    # The options live in the state too, so they can be changed while the stub is running
+    state = {"rendering": 0, "peak": 0, "requests": 0, "delay": delay,
+             "page_error_rate": page_error_rate, "service_error_rate": service_error_rate}
+
+    async def scrape(request):
+        url = (await request.json()).get("url")
+        if not url:
+            return web.json_response({"error": "Missing URL parameter"}, status=400)
+
+        state["requests"] += 1
+        state["rendering"] += 1
+        state["peak"] = max(state["peak"], state["rendering"])
+        try:
+            if max_pages is not None and state["rendering"] > max_pages:
+                print(f"More than {max_pages} pages requested at once")
+            await asyncio.sleep(state["delay"])
+            if random.random() < state["service_error_rate"]:
+                return web.Response(status=503)
+            if random.random() < state["page_error_rate"]:
+                return web.json_response({"error": f"Can't read this webpage right now because of this error: net::ERR_CONNECTION_REFUSED at {url}"}, status=500)
+            return web.json_response({"data": f"Stub page for {url}\n" + "This is a paragraph of stub text. " * 100})
+        finally:
+            state["rendering"] -= 1
+
+    async def stats(request):
+        return web.json_response(state)
+
+    app = web.Application()
+    app[STATE] = state
+    app.router.add_post("/scrape", scrape)
+    app.router.add_get("/stats", stats)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub scrape service that behaves like nodejs/app.js.")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to take over every page.")
+    parser.add_argument("--page-error-rate", type=float, default=0.0, help="Fraction of pages that fail to load.")
+    parser.add_argument("--service-error-rate", type=float, default=0.0, help="Fraction of requests answered with a bare 503.")
+    parser.add_argument("--max-pages", type=int, default=None, help="Report when more pages than this are rendering at once.")
+    args = parser.parse_args()
+    web.run_app(make_app(args.delay, args.page_error_rate, args.service_error_rate, args.max_pages), port=args.port)
@@ -0,0 +1,46 @@
+"""
+Shares one outbound call between everyone asking the same thing at the same time.
+
+When several channels ask about the same thing at once, each would otherwise make its own call
+before the first result reaches the cache. Calls are keyed by (tool name, normalized arguments):
+the first caller starts the call, and anyone asking for the same key while it's running waits
+for that call and gets its result, or its exception.
+"""
+import asyncio
+
+class ToolStats:
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+
+class SingleFlight:
+    def __init__(self):
+        self.in_flight = {}  # key -> task
+        self.tools = {}
+
+    async def run(self, key, call):
+        """Await call(), or the call already running for key. key[0] names the tool in the stats."""
+        stats = self.tools.setdefault(key[0], ToolStats())
+        task = self.in_flight.get(key)
+        if task is None:
+            stats.calls += 1
+            task = self.in_flight[key] = asyncio.create_task(call())
+            task.add_done_callback(lambda task: self.finished(key, task))
+        else:
+            stats.shared += 1
+        # Shielded so one caller's timeout doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    def finished(self, key, task):
+        del self.in_flight[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved here in case every caller stopped waiting
+
+    def stats(self):
+        return ", ".join(
+            f"{tool} {stats.calls} calls, {stats.shared} shared "
+            f"({stats.shared / (stats.calls + stats.shared) if stats.calls + stats.shared else 0:.0%})"
+            for tool, stats in self.tools.items()
+        )
+
+single_flight = SingleFlight()
@@ -0,0 +1,175 @@
+"""
+The one place the bot's SQLite databases are opened, configured and migrated.
+
+Every database is an AsyncDatabase with long-lived connections, opened when this module is
+imported, and migrated on startup to its schema in utils/schemas.py. The rest of the bot only
+uses the repository functions below.
+"""
+from utils.compression import decode_message, encode_message, load_dictionaries
+from utils.database import AsyncDatabase
+from utils.schemas import (CONVERSATION_TIMES_SCHEMA, CONVERSATIONS_SCHEMA, SCRAPE_CACHE_SCHEMA, TIMEZONES_SCHEMA,
+                           apply_migrations, schema)
+
+PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",  # Safe with WAL: a power loss can only lose the last commits, never corrupt
+    "mmap_size=268435456",
+    "temp_store=MEMORY",
+    "busy_timeout=5000",
+)
+READONLY_PRAGMAS = (
+    "mmap_size=268435456",
+    "busy_timeout=5000",
+)
+
+USERS_DB_PATH = '/home/gpu/xp-bot/users.db'
+
+# --- conversations.db ---
+
+def init_conversations(conn):
+    apply_migrations(conn, CONVERSATIONS_SCHEMA)
+    load_dictionaries(conn)
+
+conversations_db = AsyncDatabase('conversations.db', init=init_conversations, pragmas=PRAGMAS)
+
+SELECT_MESSAGES = "SELECT message FROM messages WHERE conversation_id = ? ORDER BY ordinal"
+APPEND_MESSAGE = """
+    INSERT INTO messages
+    SELECT ?, COALESCE(MAX(ordinal) + 1, 0), ?, ? FROM messages WHERE conversation_id = ?
+"""
+INSERT_MESSAGE = "INSERT INTO messages VALUES (?, ?, ?, ?)"
+DELETE_OLDEST_MESSAGES = """
+    DELETE FROM messages WHERE conversation_id = ? AND ordinal > (
+        SELECT MIN(ordinal) FROM messages WHERE conversation_id = ?
+    ) AND ordinal <= (
+        SELECT ordinal FROM messages WHERE conversation_id = ?
+        ORDER BY ordinal LIMIT 1 OFFSET ?)
+"""
+UPDATE_RECENT_MESSAGE = """
+    UPDATE messages SET role = ?, message = ?
+    WHERE conversation_id = ? AND ordinal = (
+        SELECT ordinal FROM messages WHERE conversation_id = ?
+        ORDER BY ordinal DESC LIMIT 1 OFFSET ?)
+"""
+DELETE_MESSAGES = "DELETE FROM messages WHERE conversation_id = ?"
+
+# Messages are encoded and decoded inside the jobs, so JSON and (de)compression run on the
+# database threads rather than the event loop.
+
+async def load_messages(conversation_id: int) -> list[dict]:
+    return await conversations_db.read(
+        lambda conn: [decode_message(value) for (value,) in conn.execute(SELECT_MESSAGES, (conversation_id,))]
+    )
+
+async def insert_messages(conversation_id: int, messages: list[dict], drop_oldest: int = 0) -> None:
+    """Append messages, then delete the `drop_oldest` oldest messages after the first (system) one."""
+    messages = list(messages)
+
+    def write(conn):
+        conn.executemany(APPEND_MESSAGE, [(conversation_id, m["role"], encode_message(m), conversation_id) for m in messages])
+        if drop_oldest > 0:
+            conn.execute(DELETE_OLDEST_MESSAGES, (conversation_id, conversation_id, conversation_id, drop_oldest))
+
+    await conversations_db.write(write)
+
+async def overwrite_recent_messages(conversation_id: int, messages: list[dict]) -> None:
+    """Overwrite the last len(messages) rows of a conversation in place."""
+    messages = list(messages)
+
+    def write(conn):
+        conn.executemany(
+            UPDATE_RECENT_MESSAGE,
+            [(m["role"], encode_message(m), conversation_id, conversation_id, offset) for offset, m in enumerate(reversed(messages))],
+        )
+
+    await conversations_db.write(write)
+
+async def replace_messages(conversation_id: int, messages: list[dict]) -> None:
+    messages = list(messages)
+
+    def write(conn):
+        conn.execute(DELETE_MESSAGES, (conversation_id,))
+        conn.executemany(INSERT_MESSAGE, [(conversation_id, ordinal, m["role"], encode_message(m)) for ordinal, m in enumerate(messages)])
+
+    await conversations_db.write(write)
+
+async def delete_messages(conversation_id: int) -> None:
+    await conversations_db.execute(DELETE_MESSAGES, (conversation_id,))
+
+# --- discord_timezones.db ---
+
+timezones_db = AsyncDatabase('discord_timezones.db', init=schema(TIMEZONES_SCHEMA), pragmas=PRAGMAS)
+
+SELECT_ALL_TIMEZONES = "SELECT discord_id, timezone FROM UserTimezones"
+UPSERT_TIMEZONE = "INSERT OR REPLACE INTO UserTimezones (discord_id, timezone) VALUES (?, ?)"
+
+async def load_all_timezones() -> list[tuple[int, str]]:
+    return await timezones_db.fetchall(SELECT_ALL_TIMEZONES)
+
+async def save_timezone(discord_id: int, timezone: str) -> None:
+    await timezones_db.execute(UPSERT_TIMEZONE, (discord_id, timezone))
+
+# --- conversation_times.db ---
+
+conversation_times_db = AsyncDatabase('conversation_times.db', init=schema(CONVERSATION_TIMES_SCHEMA), pragmas=PRAGMAS)
+
+SELECT_CONVERSATION_TIMES = "SELECT conversation_id, next_message_time FROM conversation_times"
+UPSERT_CONVERSATION_TIME = """
+    INSERT INTO conversation_times (conversation_id, last_message_time, next_message_time)
+    VALUES (?, ?, ?)
+    ON CONFLICT(conversation_id)
+    DO UPDATE SET last_message_time = excluded.last_message_time,
+                  next_message_time = excluded.next_message_time
+"""
+
+async def load_next_message_times() -> list[tuple[str, str]]:
+    return await conversation_times_db.fetchall(SELECT_CONVERSATION_TIMES)
+
+async def save_conversation_time(conversation_id, last_message_time: str, next_message_time: str) -> None:
+    await conversation_times_db.execute(UPSERT_CONVERSATION_TIME, (conversation_id, last_message_time, next_message_time))
+
+# --- scrape_cache.db ---
+
+scrape_cache_db = AsyncDatabase('scrape_cache.db', init=schema(SCRAPE_CACHE_SCHEMA), pragmas=PRAGMAS)
+
+SELECT_SCRAPED_PAGE = "SELECT text, content_type, etag, last_modified, fetched_at FROM scraped_pages WHERE url = ?"
+UPSERT_SCRAPED_PAGE = "INSERT OR REPLACE INTO scraped_pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+SELECT_SCRAPE_CACHE_SIZE = "SELECT COALESCE(SUM(size), 0) FROM scraped_pages"
+# Keeps the most recently used pages that fit in the given number of characters
+EVICT_SCRAPED_PAGES = """
+    DELETE FROM scraped_pages WHERE url IN (
+        SELECT url FROM (
+            SELECT url, SUM(size) OVER (ORDER BY last_used DESC) AS running_size FROM scraped_pages
+        ) WHERE running_size > ?)
+"""
+MARK_SCRAPED_PAGE_USED = "UPDATE scraped_pages SET last_used = ? WHERE url = ?"
+MARK_SCRAPED_PAGE_REVALIDATED = "UPDATE scraped_pages SET fetched_at = ?, last_used = ? WHERE url = ?"
+
+async def load_scraped_page(url: str) -> tuple | None:
+    """(text, content_type, etag, last_modified, fetched_at), or None if the page isn't cached."""
+    return await scrape_cache_db.fetchone(SELECT_SCRAPED_PAGE, (url,))
+
+async def save_scraped_page(url: str, text: str, content_type, etag, last_modified, now: float, max_size: int) -> None:
+    """Store a page, then evict the least recently used pages until the cache is within max_size characters."""
+    def write(conn):
+        conn.execute(UPSERT_SCRAPED_PAGE, (url, text, content_type, etag, last_modified, now, now, len(text)))
+        if conn.execute(SELECT_SCRAPE_CACHE_SIZE).fetchone()[0] > max_size:
+            conn.execute(EVICT_SCRAPED_PAGES, (max_size,))
+
+    await scrape_cache_db.write(write)
+
+async def mark_scraped_page_used(url: str, now: float) -> None:
+    await scrape_cache_db.execute(MARK_SCRAPED_PAGE_USED, (now, url))
+
+async def mark_scraped_page_revalidated(url: str, now: float) -> None:
+    await scrape_cache_db.execute(MARK_SCRAPED_PAGE_REVALIDATED, (now, now, url))
+
+# --- users.db (owned and written by the XP bot, read-only here) ---
+
+users_db = AsyncDatabase(USERS_DB_PATH, pragmas=READONLY_PRAGMAS, readonly=True)
+
+SELECT_USER_LEVEL = "SELECT level FROM users WHERE user_id = ?"
+
+async def load_user_level(user_id: int) -> int:
+    record = await users_db.fetchone(SELECT_USER_LEVEL, (user_id,))
+    return record[0] if record else 0
@@ -1,52 +1,79 @@
-import json
-import sqlite3
-from .count_tokens_in_conversation import count_tokens_in_conversation
-
-db_conn = sqlite3.connect('conversations.db')
-db_conn.execute("""
-CREATE TABLE IF NOT EXISTS conversations
-    (conversation_id INTEGER PRIMARY KEY,
-    conversation TEXT,
-    is_busy BOOLEAN)
-""")
+from .conversation_cache import conversation_cache
+from .count_tokens import count_messages_tokens, TOKENS_PER_REPLY
+from . import storage
+
+TOKEN_LIMIT = 30000
 
 def ensure_system_message_on_top(conversation):
     """Ensure the system message is the first message in the conversation."""
     if conversation and conversation[0]["role"] != "system":
         # Find the system message
         system_msg_idx = next((idx for idx, m in enumerate(conversation) if m["role"] == "system"), None)
-        
+
         # If a system message is found and it's not the first message, move it to the top
         if system_msg_idx is not None:
             system_message = conversation.pop(system_msg_idx)
             conversation.insert(0, system_message)
 
-def trim_conversation_to_fit_limit(conversation, token_limit, conversation_id):
-    """Trim the earliest non-system messages until the conversation is within the token limit."""
-    while count_tokens_in_conversation(conversation) > token_limit:
-        # If the second message is not a system message, remove it.
-        # This ensures the first message (system message) always remains.
-        if conversation[1]["role"] != "system":
-            conversation.pop(1)
-        else:
-            # If for some reason there are multiple system messages or the order is not as expected
-            ensure_system_message_on_top(conversation)
-            conversation.pop(2)
-        
-        store_conversation(conversation_id, conversation)
-
-def store_conversation(conversation_id, conversation, is_busy=False):
-    
-    token_limit = 30000
-    
+def trim_conversation_to_fit_limit(conversation, token_limit):
+    """
+    Trim the earliest messages after the system message until the conversation is within the token limit.
+    Returns how many were dropped so the same range can be deleted from the database.
+    """
+    # Take every message's count once (cached per message, so only new messages are
+    # tokenized) and keep a running total, rather than re-counting the whole
+    # conversation after every single message is dropped.
+    counts = count_messages_tokens(conversation)
+    total = sum(counts) + TOKENS_PER_REPLY
+    if total <= token_limit:
+        return 0
+
+    # The first message (system message) always remains.
+    dropped = 0
+    while total > token_limit and dropped < len(conversation) - 1:
+        dropped += 1
+        total -= counts[dropped]
+
+    del conversation[1:dropped + 1]
+    return dropped
+
+async def write_through(conversation_id, write):
+    """Wait for a storage write, dropping the cached copy of the conversation if it fails."""
+    try:
+        await write
+    except Exception:
+        conversation_cache.discard(conversation_id)
+        raise
+
+async def append_messages(conversation_id, conversation, messages):
+    """Append messages to the conversation and insert only the new rows."""
+    conversation.extend(messages)
+    dropped = trim_conversation_to_fit_limit(conversation, TOKEN_LIMIT)
+
+    # The cache is updated first so readers see the new messages while the write is in flight
+    conversation_cache.extend(conversation_id, messages, dropped)
+    await write_through(conversation_id, storage.insert_messages(conversation_id, messages, drop_oldest=dropped))
+
+async def append_message(conversation_id, conversation, message):
+    await append_messages(conversation_id, conversation, [message])
+
+async def update_recent_messages(conversation_id, messages):
+    """Overwrite the last len(messages) messages of a conversation in place."""
+    conversation_cache.replace_recent(conversation_id, messages)
+    await write_through(conversation_id, storage.overwrite_recent_messages(conversation_id, messages))
+
+async def delete_conversation(conversation_id):
+    conversation_cache.discard(conversation_id)
+    await storage.delete_messages(conversation_id)
+
+async def store_conversation(conversation_id, conversation):
+    """Replace the whole stored conversation. Use append_message for new messages."""
     # Ensure the system message is always the first message in the conversation
     ensure_system_message_on_top(conversation)
 
     # Trim the conversation to fit within the token (or message) limit
-    trim_conversation_to_fit_limit(conversation, token_limit, conversation_id)
+    trim_conversation_to_fit_limit(conversation, TOKEN_LIMIT)
 
     # Now, store the conversation in the database
-    c = db_conn.cursor()
-    values = (conversation_id, json.dumps(conversation), is_busy)
-    c.execute("REPLACE INTO conversations VALUES (?, ?, ?)", values)
-    db_conn.commit()
\ No newline at end of file
+    conversation_cache.put(conversation_id, conversation)
+    await write_through(conversation_id, storage.replace_messages(conversation_id, conversation))
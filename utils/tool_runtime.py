@@ -0,0 +1,102 @@
+"""
+Runs the tools declared in chat_functions.tools.
+
+Tool calls arrive as deltas spread over the streamed reply; ToolCallAccumulator puts them back
+together. All the calls from one assistant turn then run concurrently, each under its own
+timeout, and their results go back to the model together as function messages.
+"""
+import asyncio
+import json
+import os
+import random
+from dotenv import load_dotenv
+from strings import google_search_messages, scrape_web_page_messages
+from utils.google_search import google_search
+from utils.prefetch import prefetcher
+from utils.scrape_web_page import SCRAPE_TIMEOUT
+from utils.wolfram_alpha import query_wolfram_alpha
+
+load_dotenv()
+google_api_key = os.getenv("GOOGLE_API_KEY")
+google_cse_id = os.getenv("GOOGLE_CSE_ID")
+
+class ToolCallAccumulator:
+    def __init__(self):
+        self.calls = {}
+
+    def add(self, deltas):
+        for delta in deltas:
+            call = self.calls.setdefault(delta.index, {"id": None, "name": "", "arguments": ""})
+            if delta.id:
+                call["id"] = delta.id
+            if delta.function:
+                call["name"] += delta.function.name or ""
+                call["arguments"] += delta.function.arguments or ""
+
+    def __bool__(self):
+        return bool(self.calls)
+
+    def tool_calls(self):
+        return [self.calls[index] for index in sorted(self.calls)]
+
+class Tool:
+    def __init__(self, run, timeout, status):
+        self.run = run
+        self.timeout = timeout
+        self.status = status  # What to show while it runs, given the call's arguments
+
+async def run_google_search(search_term, num_results=5):
+    results = await google_search(search_term=search_term, num_results=num_results or 5, api_key=google_api_key, cse_id=google_cse_id)
+    return "Give these results to the user in a conversational format, not a list. Never deliver the results in a list. Here they are: " + results
+
+async def run_scrape_web_page(url, query=None):
+    return await prefetcher.scrape(url, query)
+
+async def run_wolfram_alpha(query):
+    return await query_wolfram_alpha(query)
+
+TOOLS = {
+    "google_search": Tool(run_google_search, 30, lambda arguments: random.choice(google_search_messages).format(arguments.get("search_term"))),
+    "scrape_web_page": Tool(run_scrape_web_page, SCRAPE_TIMEOUT, lambda arguments: random.choice(scrape_web_page_messages).format(arguments.get("url"))),
+    "ask_wolfram_alpha": Tool(run_wolfram_alpha, 15, lambda arguments: "Checking my answer for " + str(arguments.get("query"))),
+}
+
+def parse_arguments(call):
+    try:
+        arguments = json.loads(call["arguments"] or "{}")
+    except json.JSONDecodeError:
+        return None
+    return arguments if isinstance(arguments, dict) else None
+
+def tool_status(calls):
+    lines = []
+    for call in calls:
+        tool = TOOLS.get(call["name"])
+        arguments = parse_arguments(call)
+        if tool and arguments is not None:
+            lines.append(tool.status(arguments))
+    return "\n".join(lines) or "Working on your request..."
+
+async def run_tool_call(call):
+    name = call["name"]
+    tool = TOOLS.get(name)
+    if tool is None:
+        return f"There is no tool called {name}."
+    arguments = parse_arguments(call)
+    if arguments is None:
+        return f"The arguments for {name} weren't a valid JSON object: {call['arguments']}"
+
+    print(f"(debug) Running {name} with {arguments}")
+    try:
+        result = await asyncio.wait_for(tool.run(**arguments), tool.timeout)
+    except asyncio.TimeoutError:
+        return f"{name} didn't finish within {tool.timeout:g} seconds."
+    except Exception as e:
+        print(f"(debug) {name} failed: {e}")
+        return f"{name} failed: {e}"
+    return result if result is not None else f"{name} returned no results."
+
+async def run_tool_calls(calls):
+    """Run every call at once. Returns one function message per call, in the order they were made."""
+    results = await asyncio.gather(*(run_tool_call(call) for call in calls))
+    return [{"role": "function", "name": call["name"], "content": result} for call, result in zip(calls, results)]
@@ -0,0 +1,109 @@
+"""
+Decides which conversation gets to talk to the model next.
+
+At most LLM_MAX_CONCURRENT_TURNS replies are generated at once. When more are waiting, they
+are served by weighted fair queuing: every channel (or DM) is its own flow. Each queued turn
+gets a virtual finish time of 1 / weight after its flow's previous turn, and the earliest
+finish time goes next. A busy guild channel can't starve the others, and a user in a higher
+tier (by XP level, see check_user_level) gets a bigger share when there's contention.
+"""
+import asyncio
+import contextlib
+import heapq
+import itertools
+import os
+import time
+import cachetools
+from dotenv import load_dotenv
+from utils.check_user_level import check_user_level
+
+load_dotenv()
+MAX_CONCURRENT_TURNS = int(os.getenv("LLM_MAX_CONCURRENT_TURNS", "8"))
+USE_LEVEL_TIERS = os.getenv("LLM_LEVEL_TIERS", "true").lower() == "true"
+
+# (tier, minimum XP level, weight), highest first
+TIERS = (
+    ("veteran", 20, 4),
+    ("member", 5, 2),
+    ("newcomer", 0, 1),
+)
+TIER_WEIGHTS = {tier: weight for tier, _, weight in TIERS}
+
+async def user_tier(user_id):
+    if not USE_LEVEL_TIERS:
+        return "newcomer"
+    level = await check_user_level(user_id)
+    return next(tier for tier, min_level, _ in TIERS if level >= min_level)
+
+class TierStats:
+    def __init__(self):
+        self.queued = 0
+        self.peak_queued = 0
+        self.turns = 0
+        self.wait_time = 0.0
+
+class TurnScheduler:
+    def __init__(self, max_concurrent=MAX_CONCURRENT_TURNS):
+        self.max_concurrent = max_concurrent
+        self.running = 0
+        self.waiting = []  # Heap of (finish time, arrival order, future, tier)
+        self.virtual_time = 0.0
+        self.flow_finish = cachetools.LRUCache(10000)
+        self.arrivals = itertools.count()
+        self.tiers = {tier: TierStats() for tier in TIER_WEIGHTS}
+
+    @contextlib.asynccontextmanager
+    async def turn(self, message):
+        """Hold one of the model slots while generating a reply to message."""
+        tier = await user_tier(message.author.id)
+        await self.acquire(message.channel.id, tier)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, flow, tier):
+        stats = self.tiers[tier]
+        started = time.monotonic()
+        finish = max(self.virtual_time, self.flow_finish.get(flow, 0.0)) + 1 / TIER_WEIGHTS[tier]
+        self.flow_finish[flow] = finish
+        if self.running < self.max_concurrent and not self.waiting:
+            self.running += 1
+            self.virtual_time = finish
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, (finish, next(self.arrivals), future, tier))
+            stats.queued += 1
+            stats.peak_queued = max(stats.peak_queued, stats.queued)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    stats.queued -= 1
+                else:
+                    # Given a slot just as we were cancelled; pass it on
+                    self.release()
+                raise
+        stats.turns += 1
+        stats.wait_time += time.monotonic() - started
+
+    def release(self):
+        self.running -= 1
+        while self.waiting and self.running < self.max_concurrent:
+            finish, _, future, tier = heapq.heappop(self.waiting)
+            if future.cancelled():
+                continue
+            self.running += 1
+            self.virtual_time = finish
+            self.tiers[tier].queued -= 1
+            future.set_result(None)
+
+    def stats(self):
+        tiers = ", ".join(
+            f"{tier} {stats.queued} queued (peak {stats.peak_queued}), "
+            f"{stats.turns} turns, {stats.wait_time / stats.turns if stats.turns else 0:.2f}s mean wait"
+            for tier, stats in self.tiers.items()
+        )
+        return f"{self.running}/{self.max_concurrent} running; {tiers}"
+
+turn_scheduler = TurnScheduler()
@@ -1,26 +1,66 @@
-import requests
 import json
 import os
+import re
+import aiohttp
+import cachetools
 from dotenv import load_dotenv
+from utils.http_session import http_session
+from utils.single_flight import single_flight
 
-def query_wolfram_alpha(query):
-    load_dotenv()
-    api_key = os.getenv("WOLFRAM_ALPHA_API_KEY")
-    
-    base_url = "http://api.wolframalpha.com/v2/query?"
-    params = {
-        "input": query,
-        "format": "plaintext",  
-        "output": "JSON",
-        "appid": api_key,
-    }
-    response = requests.get(base_url, params=params)
-    
-    if response.status_code == 200:
-        filtered_response = filter_relevant_info(response.json())
+load_dotenv()
+WOLFRAM_ALPHA_API_KEY = os.getenv("WOLFRAM_ALPHA_API_KEY")
+WOLFRAM_TIMEOUT = float(os.getenv("WOLFRAM_TIMEOUT", "10"))
+WOLFRAM_CACHE_SIZE = int(os.getenv("WOLFRAM_CACHE_SIZE", "5000"))
+BASE_URL = "https://api.wolframalpha.com/v2/query"
+
+def normalize_query(query):
+    """Questions that only differ in case, spacing or a trailing question mark share a cache entry."""
+    return re.sub(r"\s+", " ", query).strip().rstrip("?").strip().casefold()
+
+class WolframAlphaClient:
+    def __init__(self, api_key=WOLFRAM_ALPHA_API_KEY, timeout=WOLFRAM_TIMEOUT, cache_size=WOLFRAM_CACHE_SIZE):
+        self.api_key = api_key
+        self.timeout = timeout
+        # Answers to maths and unit conversions don't change, so there's no expiry
+        self.cache = cachetools.LRUCache(maxsize=cache_size)
+        self.hits = 0
+        self.misses = 0
+
+    async def query(self, query):
+        key = normalize_query(query)
+        if key in self.cache:
+            self.hits += 1
+            print("(debug) Using cached Wolfram Alpha result.")
+            return self.cache[key]
+        self.misses += 1
+        return await single_flight.run(("ask_wolfram_alpha", key), lambda: self.fetch(query, key))
+
+    async def fetch(self, query, key):
+        params = {
+            "input": query,
+            "format": "plaintext",
+            "output": "JSON",
+            "appid": self.api_key,
+        }
+        async with http_session().get(BASE_URL, params=params, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+            if response.status != 200:
+                print(f"(debug) Wolfram Alpha answered {response.status}")
+                return None
+            result_json = await response.json(content_type=None)
+
+        filtered_response = filter_relevant_info(result_json)
+        self.cache[key] = filtered_response
         return filtered_response
-    else:
-        return None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f"{len(self.cache)}/{self.cache.maxsize} cached, {self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate)"
+
+wolfram_alpha = WolframAlphaClient()
+
+async def query_wolfram_alpha(query):
+    return await wolfram_alpha.query(query)
 
 def filter_relevant_info(result_json):
     relevant_info = {}
@@ -34,5 +74,5 @@ def filter_relevant_info(result_json):
     return json.dumps(relevant_info)  # Convert dict to JSON-formatted string
 
 # Example usage
-# result = query_wolfram_alpha("What is the capital of France?")
+# result = asyncio.run(query_wolfram_alpha("What is the capital of France?"))
 # print(result)  # This will print a JSON-formatted string
@@ -1,7 +1,7 @@
 from .count_tokens_in_conversation import count_tokens_in_conversation
-from .count_tokens import count_tokens
+from .count_tokens import count_tokens, TOKENS_PER_MESSAGE
 
 def would_exceed_limit(conversation, new_message, limit):
     return (
-        count_tokens_in_conversation(conversation) + count_tokens(new_message) > limit
+        count_tokens_in_conversation(conversation) + count_tokens(new_message) + TOKENS_PER_MESSAGE > limit
     )